@@ -1,20 +1,69 @@
 import os
+import sys
 import time
-import requests
-from flask import Flask, request, jsonify, render_template
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from flask import Flask, Response, g, request, jsonify, render_template
+from markupsafe import Markup
+import qrcode
+import qrcode.image.svg
 from flask_httpauth import HTTPBasicAuth
-from solana.publickey import PublicKey
-from solana.rpc.api import Client
-from solana.transaction import Transaction, TransactionInstruction
-from solana.rpc.commitment import Confirmed
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
 from dotenv import load_dotenv
 import logging
 
+# The Solana RPC client is shared with the vending machine server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+from solana_rpc import SolanaRpcClient
+
 # Load environment variables
 load_dotenv()
 
+# Solana RPC settings; SOLANA_RPC_URL may list several comma-separated endpoints to fail over across
+SOLANA_RPC_URLS = [url.strip() for url in os.getenv('SOLANA_RPC_URL', 'https://api.mainnet-beta.solana.com').split(',') if url.strip()]
+RPC_MAX_CONCURRENCY = int(os.getenv('RPC_MAX_CONCURRENCY', '8'))
+RECENT_TRANSACTION_LIMIT = 10
+TRANSACTION_CACHE_SIZE = int(os.getenv('TRANSACTION_CACHE_SIZE', '1024'))
+TRANSACTION_CACHE_TTL = int(os.getenv('TRANSACTION_CACHE_TTL', '3600'))
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', '64'))
+QR_MAX_AGE = int(os.getenv('QR_MAX_AGE', '86400'))
+
+# Prometheus metrics
+REQUESTS = Counter('atm_requests_total', 'Total number of requests', ['endpoint', 'status'])
+LATENCY = Histogram('atm_request_latency_seconds', 'Request latency in seconds', ['endpoint'])
+RPC_CALLS = Counter('atm_rpc_calls_total', 'Solana RPC calls sent', ['method', 'result'])
+RPC_LATENCY = Histogram('atm_rpc_latency_seconds', 'Solana RPC round trip in seconds', ['method'])
+RPC_QUEUE_WAIT = Histogram(
+    'atm_rpc_queue_wait_seconds', 'Time transaction lookups wait for an RPC_MAX_CONCURRENCY slot',
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5)
+)
+CACHE_LOOKUPS = Counter('atm_cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+
+def observe_rpc_call(method, seconds, ok):
+    RPC_CALLS.labels(method, 'ok' if ok else 'error').inc()
+    RPC_LATENCY.labels(method).observe(seconds)
+
+# All RPC traffic runs on one long-lived event loop in a background thread, so the
+# client's connection pool is shared by every request whichever thread serves it
+rpc_loop = asyncio.new_event_loop()
+threading.Thread(target=rpc_loop.run_forever, name='solana-rpc', daemon=True).start()
+
 # Initialize Solana client
-client = Client("https://api.mainnet-beta.solana.com")
+client = SolanaRpcClient(SOLANA_RPC_URLS, observer=observe_rpc_call)
+rpc_semaphore = asyncio.Semaphore(RPC_MAX_CONCURRENCY)
+
+# Confirmed transactions never change, so their parsed balance deltas are cached by
+# signature (signature -> (cached_at, lamports)). Only the RPC loop touches these.
+transaction_cache = OrderedDict()
+# Newest-first window of the latest signatures seen for the receiver; the newest one
+# is the cursor for the next poll
+recent_signatures = deque(maxlen=RECENT_TRANSACTION_LIMIT)
+# The signature refresh in flight, shared by every check_payment that arrives meanwhile
+refresh_task = None
 
 # Initialize Flask app and authentication
 app = Flask(__name__)
@@ -29,6 +78,99 @@ RECEIVER_ADDRESS = os.getenv('ATM_PUBLIC_KEY')
 BASIC_AUTH_USERNAME = os.getenv('BASIC_AUTH_USERNAME')
 BASIC_AUTH_PASSWORD = os.getenv('BASIC_AUTH_PASSWORD')
 
+async def run_rpc(coro):
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, rpc_loop))
+
+def get_cached_delta(signature):
+    entry = transaction_cache.get(signature)
+    if entry is not None and time.time() - entry[0] > TRANSACTION_CACHE_TTL:
+        del transaction_cache[signature]
+        entry = None
+    CACHE_LOOKUPS.labels('transaction', 'miss' if entry is None else 'hit').inc()
+    if entry is None:
+        return None
+    transaction_cache.move_to_end(signature)
+    return entry[1]
+
+def cache_delta(signature, delta):
+    transaction_cache[signature] = (time.time(), delta)
+    transaction_cache.move_to_end(signature)
+    while len(transaction_cache) > TRANSACTION_CACHE_SIZE:
+        transaction_cache.popitem(last=False)
+
+async def fetch_balance_delta(signature):
+    delta = get_cached_delta(signature)
+    if delta is not None:
+        return delta
+    queued_at = time.perf_counter()
+    async with rpc_semaphore:
+        RPC_QUEUE_WAIT.observe(time.perf_counter() - queued_at)
+        tx_details = await client.get_transaction(signature)
+    pre_balances = tx_details['meta']['preBalances']
+    post_balances = tx_details['meta']['postBalances']
+    delta = post_balances[0] - pre_balances[0]
+    cache_delta(signature, delta)
+    return delta
+
+async def refresh_recent_signatures(limit):
+    # Only ask for signatures newer than the ones seen by the previous poll
+    until = recent_signatures[0] if recent_signatures else None
+    response = await client.get_signatures_for_address(RECEIVER_ADDRESS, limit=limit, until=until)
+    # Everything runs on rpc_loop and one refresh is in flight at a time, so no lock is
+    # needed around the window and its cursor
+    recent_signatures.extendleft(reversed([tx['signature'] for tx in response]))
+
+def clear_refresh_task(task):
+    global refresh_task
+    if refresh_task is task:
+        refresh_task = None
+
+async def fetch_recent_balance_deltas(limit):
+    global refresh_task
+    # Single-flight: concurrent checks share one getSignaturesForAddress round trip
+    # instead of queueing behind each other for it
+    if refresh_task is None:
+        refresh_task = asyncio.ensure_future(refresh_recent_signatures(limit))
+        refresh_task.add_done_callback(clear_refresh_task)
+    await asyncio.shield(refresh_task)
+    signatures = list(recent_signatures)
+    # Fetch uncached transaction bodies concurrently, at most RPC_MAX_CONCURRENCY at a time;
+    # the RPC client coalesces them into a batch request
+    return await asyncio.gather(*(fetch_balance_delta(signature) for signature in signatures))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    if endpoint != 'metrics':
+        REQUESTS.labels(endpoint, response.status_code).inc()
+        LATENCY.labels(endpoint).observe(time.perf_counter() - g.request_started)
+    return response
+
+def normalize_amount(amount):
+    # "0.10", "0.1" and "1e-1" are the same denomination and share a cache entry
+    try:
+        value = Decimal(amount)
+    except (InvalidOperation, TypeError):
+        return None
+    # Positive, at most lamport precision, and nowhere near an overflowing QR payload
+    if not value.is_finite() or value <= 0 or value.adjusted() > 12 or value.normalize().as_tuple().exponent < -9:
+        return None
+    return format(value.normalize(), 'f')
+
+# ATMs offer a small set of denominations, so rendered pages are kept in a bounded
+# LRU keyed by amount and receiver. Returns the page and its ETag.
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def render_qr_page(amount, receiver):
+    solana_pay_url = f"solana:{receiver}?amount={amount}&label=ATM%20Payment&message=Payment%20for%20services"
+    # Rendered locally as inline SVG; the payment URL never leaves the server
+    qr_svg = qrcode.make(solana_pay_url, image_factory=qrcode.image.svg.SvgPathImage).to_string(encoding='unicode')
+    page = render_template('qr_code.html', qr_svg=Markup(qr_svg), amount=amount)
+    return page, hashlib.sha256(page.encode()).hexdigest()[:32]
+
 # User authentication
 @auth.verify_password
 def verify_password(username, password):
@@ -42,19 +184,26 @@ def generate_qr():
         amount = request.args.get('amount')
         if not amount:
             return jsonify({"error": "Amount is required"}), 400
+        amount = normalize_amount(amount)
+        if amount is None:
+            return jsonify({"error": "Amount must be a positive number"}), 400
 
-        # Generate Solana Pay URL
-        solana_pay_url = f"solana:{RECEIVER_ADDRESS}?amount={amount}&label=ATM%20Payment&message=Payment%20for%20services"
+        page, etag = render_qr_page(amount, RECEIVER_ADDRESS)
+        response = Response(page, mimetype='text/html')
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = QR_MAX_AGE
 
         logging.info(f'Generated QR for amount: {amount} SOL')
-        return render_template('qr_code.html', solana_pay_url=solana_pay_url)
+        # Answers 304 Not Modified when the client already holds this page
+        return response.make_conditional(request)
     except Exception as e:
         logging.error(f'Error generating QR: {e}')
         return jsonify({"error": "Internal server error"}), 500
 
 @app.route('/check_payment', methods=['POST'])
 @auth.login_required
-def check_payment():
+async def check_payment():
     try:
         data = request.get_json()
         amount = data.get('amount')
@@ -64,13 +213,9 @@ def check_payment():
         amount_lamports = int(float(amount) * 1e9)
 
         # Check for recent transactions
-        response = client.get_confirmed_signature_for_address2(PublicKey(RECEIVER_ADDRESS), limit=10, commitment=Confirmed)
-        for tx in response['result']:
-            tx_details = client.get_confirmed_transaction(tx['signature'], commitment=Confirmed)
-            pre_balances = tx_details['result']['meta']['preBalances']
-            post_balances = tx_details['result']['meta']['postBalances']
-
-            if (post_balances[0] - pre_balances[0]) >= amount_lamports:
+        deltas = await run_rpc(fetch_recent_balance_deltas(RECENT_TRANSACTION_LIMIT))
+        for delta in deltas:
+            if delta >= amount_lamports:
                 logging.info(f'Payment received: {amount} SOL')
                 return jsonify({"status": "Payment received"}), 200
 
@@ -92,5 +237,10 @@ def webhook():
         logging.error(f'Error in webhook: {e}')
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/metrics', methods=['GET'])
+@auth.login_required
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import random
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+from aiohttp import web
+from base58 import b58encode
+
+SYSTEM_PROGRAM = "11111111111111111111111111111111"
+
+def random_key() -> str:
+    return b58encode(os.urandom(32)).decode('ascii')
+
+# Local stand-in for a Solana JSON-RPC node. It serves getSignaturesForAddress and
+# getTransaction (json encoding) from an in-memory ledger, supports batch requests,
+# adds a configurable latency to every HTTP request and counts the calls it serves.
+class MockSolanaRpc:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, history_size: int = 1000):
+        self.latency = latency
+        self.jitter = jitter
+        self.history_size = history_size
+        self.transactions: Dict[str, Dict[str, Any]] = {}
+        self.history: Dict[str, List[Dict[str, Any]]] = defaultdict(list)  # newest first
+        self.slot = 1
+        self.http_requests = 0
+        self.calls: Counter = Counter()
+        self.runner: Optional[web.AppRunner] = None
+
+    def seed(self, address: str, count: Optional[int] = None) -> None:
+        # Unrelated incoming transfers, so lookups see a realistic history
+        for _ in range(self.history_size if count is None else count):
+            self.add_transfer(random_key(), address, random.randint(1, 10_000), references=[])
+
+    def add_transfer(self, payer: str, recipient: str, lamports: int, references: List[str]) -> str:
+        signature = b58encode(os.urandom(64)).decode('ascii')
+        self.slot += 1
+        account_keys = [payer, recipient] + references + [SYSTEM_PROGRAM]
+        pre_balances = [10_000_000_000, 1_000_000_000] + [0] * len(references) + [1]
+        post_balances = [pre_balances[0] - lamports - 5000, pre_balances[1] + lamports] + [0] * len(references) + [1]
+        self.transactions[signature] = {
+            'slot': self.slot,
+            'blockTime': int(time.time()),
+            'meta': {'err': None, 'fee': 5000, 'preBalances': pre_balances, 'postBalances': post_balances},
+            'transaction': {
+                'signatures': [signature],
+                'message': {
+                    'accountKeys': account_keys,
+                    'header': {
+                        'numRequiredSignatures': 1,
+                        'numReadonlySignedAccounts': 0,
+                        'numReadonlyUnsignedAccounts': len(references) + 1
+                    },
+                    # A System Program transfer with the references appended, as Solana Pay wallets build it
+                    'instructions': [{
+                        'programIdIndex': len(account_keys) - 1,
+                        'accounts': list(range(len(account_keys) - 1)),
+                        'data': ''
+                    }]
+                }
+            }
+        }
+        status = {'signature': signature, 'slot': self.slot, 'err': None, 'blockTime': int(time.time())}
+        for address in (payer, recipient):
+            entries = self.history[address]
+            entries.insert(0, status)
+            del entries[self.history_size:]
+        return signature
+
+    def pay(self, recipient: str, reference: str, lamports: int) -> str:
+        return self.add_transfer(random_key(), recipient, lamports, references=[reference])
+
+    def get_signatures_for_address(self, address: str, options: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        options = options or {}
+        entries = self.history.get(address, [])
+        signatures = [entry['signature'] for entry in entries]
+        start = 0
+        if options.get('before') in signatures:
+            start = signatures.index(options['before']) + 1
+        end = len(entries)
+        if options.get('until') in signatures:
+            end = signatures.index(options['until'])
+        limit = options.get('limit') or 1000
+        return entries[start:end][:limit]
+
+    def dispatch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        method = request.get('method')
+        params = request.get('params') or []
+        self.calls[method] += 1
+        response: Dict[str, Any] = {'jsonrpc': '2.0', 'id': request.get('id')}
+        if method == 'getSignaturesForAddress':
+            response['result'] = self.get_signatures_for_address(*params)
+        elif method == 'getTransaction':
+            response['result'] = self.transactions.get(params[0])
+        elif method == 'getHealth':
+            response['result'] = 'ok'
+        else:
+            response['error'] = {'code': -32601, 'message': f"Method not found: {method}"}
+        return response
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.http_requests += 1
+        body = await request.json()
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if isinstance(body, list):
+            return web.json_response([self.dispatch(item) for item in body])
+        return web.json_response(self.dispatch(body))
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{bound_port}/"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
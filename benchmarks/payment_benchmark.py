@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import tempfile
+import threading
+import contextlib
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+import aiohttp
+from aiohttp import web
+from cryptography.fernet import Fernet
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+VENDING_SCRIPTS = os.path.join(REPO_ROOT, 'vending machines', 'scripts')
+ATMS_SCRIPTS = os.path.join(REPO_ROOT, 'ATMS', 'scripts')
+sys.path.insert(0, HERE)
+
+from mock_solana_rpc import MockSolanaRpc, random_key
+
+logger = logging.getLogger('benchmark')
+
+API_KEY = 'benchmark-api-key'
+ATM_USER = 'benchmark'
+ATM_PASSWORD = 'benchmark'
+LAMPORTS_PER_SOL = 1_000_000_000
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+# Collects per-endpoint latencies and errors for one benchmark phase
+class LatencyRecorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    @contextlib.asynccontextmanager
+    async def measure(self, endpoint: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors[endpoint] += 1
+            raise
+        finally:
+            self.samples[endpoint].append(time.perf_counter() - started)
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        self.samples[endpoint].append(seconds)
+
+    def finish(self) -> None:
+        self.finished = time.perf_counter()
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        duration = (self.finished or time.perf_counter()) - self.started
+        return {
+            endpoint: {
+                'count': len(samples),
+                'errors': self.errors[endpoint],
+                'throughput_rps': len(samples) / duration if duration else 0.0,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p95_ms': percentile(samples, 95) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+            }
+            for endpoint, samples in sorted(self.samples.items())
+        }
+
+def write_json(path: str, data: Dict[str, Any]) -> None:
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+async def start_vending_server(args: argparse.Namespace, workdir: str, rpc_url: str, merchant: str):
+    config = {
+        'port': 0,
+        'host': '127.0.0.1',
+        'solana_network': rpc_url,
+        'merchant_wallet': merchant,
+        'merchant_private_key': '',
+        'api_key': API_KEY,
+        'redis_url': args.redis_url or 'redis://localhost:6379/0',
+        'encryption_key': Fernet.generate_key().decode(),
+        'sentry_dsn': '',
+        'ssl_cert': '',
+        'ssl_key': '',
+        'watcher_interval': args.watcher_interval,
+        'long_poll_timeout': args.long_poll_timeout,
+        # Every simulated machine shares one API key
+        'machines_per_api_key': args.machines,
+    }
+    if not args.respect_rate_limits:
+        # Benchmarks measure capacity, not the per-machine budgets
+        config['rate_limits'] = {
+            endpoint: {'rate': 100_000, 'burst': 100_000}
+            for endpoint in ('generate_payment', 'generate_payments', 'verify_payment', 'wait_payment',
+                             'transaction_status', 'transaction_status_batch', 'qr_code', 'inventory_sync', 'inventory')
+        }
+    config_path = os.path.join(workdir, 'server_config.json')
+    write_json(config_path, config)
+
+    sys.path.insert(0, VENDING_SCRIPTS)
+    import server
+
+    if not args.redis_url:
+        # Without a Redis URL every server connection shares one in-process fakeredis
+        import fakeredis
+        import fakeredis.aioredis
+        fake_server = fakeredis.FakeServer()
+        server.aioredis.from_url = lambda url, **kwargs: fakeredis.aioredis.FakeRedis(server=fake_server, **kwargs)
+
+    runner = web.AppRunner(server.create_app(config_path))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    server_url = f"http://127.0.0.1:{port}"
+
+    # Measure a warm server, not its first requests
+    async with aiohttp.ClientSession() as session:
+        while True:
+            async with session.get(f"{server_url}/ready") as response:
+                if response.status == 200:
+                    break
+            await asyncio.sleep(0.1)
+    return runner, server_url
+
+def start_atm_server(rpc_url: str, atm_address: str):
+    os.environ.update({
+        'SOLANA_RPC_URL': rpc_url,
+        'ATM_PUBLIC_KEY': atm_address,
+        'BASIC_AUTH_USERNAME': ATM_USER,
+        'BASIC_AUTH_PASSWORD': ATM_PASSWORD,
+        'FLASK_SECRET_KEY': 'benchmark',
+    })
+    sys.path.insert(0, ATMS_SCRIPTS)
+    import solana_pay_server
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    httpd = make_server('127.0.0.1', 0, solana_pay_server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, name='atm-server', daemon=True).start()
+    return httpd, f"http://127.0.0.1:{httpd.server_port}"
+
+async def simulate_machine(index: int, args: argparse.Namespace, server_url: str, merchant: str,
+                           mock: MockSolanaRpc, recorder: LatencyRecorder, verified: Counter) -> None:
+    import vendingmachine as vm
+
+    # A SolanaPaymentGateway that times every request it makes to the server
+    class TimedGateway(vm.SolanaPaymentGateway):
+        async def post(self, path: str, payload: dict, *args, **kwargs) -> dict:
+            async with recorder.measure(path.lstrip('/')):
+                return await super().post(path, payload, *args, **kwargs)
+
+    config = vm.Config(
+        server_url=server_url,
+        mdb_port=vm.SIMULATED_MDB_PORT,
+        api_key=API_KEY,
+        solana_wallet_address=merchant,
+        payment_verification_timeout=args.payment_timeout,
+        payment_verification_interval=args.poll_interval,
+        payment_long_poll_timeout=args.long_poll_timeout,
+        machine_id=f"benchmark-{index}",
+        http_max_retries=0,
+        payment_pool_size=0,
+    )
+    item = vm.Item('A1', args.price, 'Benchmark item', args.payments_per_machine)
+    loop = asyncio.get_running_loop()
+
+    async with TimedGateway(config) as gateway:
+        for _ in range(args.payments_per_machine):
+            selected = time.perf_counter()
+            memo = await gateway.get_payment_url(item)
+            if not memo:
+                continue
+
+            # The customer pays from their wallet a little after the QR appears
+            loop.call_later(args.pay_delay, mock.pay, merchant, memo, int(args.price * LAMPORTS_PER_SOL))
+
+            deadline = time.time() + args.payment_timeout
+            is_verified = False
+            while not is_verified and (remaining := deadline - time.time()) > 0:
+                if args.mode == 'long-poll':
+                    is_verified = await gateway.wait_for_payment(memo, min(remaining, args.long_poll_timeout))
+                else:
+                    is_verified = await gateway.verify_payment(memo)
+                    if not is_verified:
+                        await asyncio.sleep(args.poll_interval)
+            if is_verified:
+                verified['payments'] += 1
+                recorder.record('selection_to_verified', time.perf_counter() - selected)
+
+            with contextlib.suppress(aiohttp.ClientError, asyncio.TimeoutError):
+                async with recorder.measure('transaction_status'):
+                    async with gateway.session.get(f"{server_url}/transaction_status", params={'memo': memo}) as response:
+                        response.raise_for_status()
+                        await response.json()
+
+async def simulate_atm_client(args: argparse.Namespace, session: aiohttp.ClientSession, atm_url: str,
+                              recorder: LatencyRecorder) -> None:
+    auth = aiohttp.BasicAuth(ATM_USER, ATM_PASSWORD)
+    amount = str(args.price)
+    for _ in range(args.atm_requests):
+        with contextlib.suppress(aiohttp.ClientError, asyncio.TimeoutError):
+            async with recorder.measure('atm_generate_qr'):
+                async with session.get(f"{atm_url}/generate_qr", params={'amount': amount}, auth=auth) as response:
+                    response.raise_for_status()
+                    await response.read()
+        with contextlib.suppress(aiohttp.ClientError, asyncio.TimeoutError):
+            async with recorder.measure('atm_check_payment'):
+                async with session.post(f"{atm_url}/check_payment", json={'amount': amount}, auth=auth) as response:
+                    # 404 is the normal "payment not received" answer
+                    if response.status != 404:
+                        response.raise_for_status()
+                    await response.read()
+
+async def run_vending_phase(args: argparse.Namespace, workdir: str, mock: MockSolanaRpc, rpc_url: str) -> Dict[str, Any]:
+    merchant = random_key()
+    mock.seed(merchant)
+
+    runner, server_url = await start_vending_server(args, workdir, rpc_url, merchant)
+    try:
+        calls_before = mock.total_calls
+        requests_before = mock.http_requests
+        recorder = LatencyRecorder()
+        verified: Counter = Counter()
+        await asyncio.gather(*(
+            simulate_machine(i, args, server_url, merchant, mock, recorder, verified)
+            for i in range(args.machines)
+        ))
+        recorder.finish()
+        rpc_calls = mock.total_calls - calls_before
+        return {
+            'endpoints': recorder.report(),
+            'verified_payments': verified['payments'],
+            'rpc_calls': rpc_calls,
+            'rpc_http_requests': mock.http_requests - requests_before,
+            'rpc_calls_per_verified_payment': rpc_calls / verified['payments'] if verified['payments'] else None,
+        }
+    finally:
+        await runner.cleanup()
+
+async def run_atm_phase(args: argparse.Namespace, mock: MockSolanaRpc, rpc_url: str) -> Dict[str, Any]:
+    atm_address = random_key()
+    mock.seed(atm_address)
+    httpd, atm_url = start_atm_server(rpc_url, atm_address)
+    try:
+        calls_before = mock.total_calls
+        recorder = LatencyRecorder()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(simulate_atm_client(args, session, atm_url, recorder) for _ in range(args.atm_clients)))
+        recorder.finish()
+        checks = len(recorder.samples['atm_check_payment'])
+        rpc_calls = mock.total_calls - calls_before
+        return {
+            'endpoints': recorder.report(),
+            'rpc_calls': rpc_calls,
+            'rpc_calls_per_check_payment': rpc_calls / checks if checks else None,
+        }
+    finally:
+        httpd.shutdown()
+
+def print_report(title: str, results: Dict[str, Any]) -> None:
+    print(f"\n== {title} ==")
+    print(f"{'endpoint':<24}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, stats in results['endpoints'].items():
+        print(f"{endpoint:<24}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_rps']:>10.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    for key, value in results.items():
+        if key != 'endpoints':
+            print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
+
+async def main(args: argparse.Namespace) -> None:
+    mock = MockSolanaRpc(latency=args.rpc_latency / 1000, jitter=args.rpc_jitter / 1000, history_size=args.history_size)
+    rpc_url = await mock.start()
+    results: Dict[str, Any] = {'settings': vars(args)}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            os.makedirs('qr_codes', exist_ok=True)
+            if not args.skip_vending:
+                results['vending'] = await run_vending_phase(args, workdir, mock, rpc_url)
+                print_report(f"Vending server: {args.machines} machines x {args.payments_per_machine} payments ({args.mode})",
+                             results['vending'])
+            if not args.skip_atm:
+                results['atm'] = await run_atm_phase(args, mock, rpc_url)
+                print_report(f"ATM server: {args.atm_clients} clients x {args.atm_requests} requests", results['atm'])
+    finally:
+        await mock.stop()
+
+    if args.output:
+        write_json(args.output, results)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the payment servers")
+    parser.add_argument('--machines', type=int, default=20, help="simulated vending machines")
+    parser.add_argument('--payments-per-machine', type=int, default=5)
+    parser.add_argument('--mode', choices=['long-poll', 'poll'], default='long-poll',
+                        help="wait on /wait_payment or poll /verify_payment")
+    parser.add_argument('--price', type=float, default=0.5, help="item price in SOL")
+    parser.add_argument('--pay-delay', type=float, default=1.0, help="seconds before the simulated customer pays")
+    parser.add_argument('--payment-timeout', type=float, default=30)
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--long-poll-timeout', type=float, default=10)
+    parser.add_argument('--watcher-interval', type=float, default=0.5)
+    parser.add_argument('--atm-clients', type=int, default=10)
+    parser.add_argument('--atm-requests', type=int, default=20, help="requests per ATM client")
+    parser.add_argument('--rpc-latency', type=float, default=50, help="mock RPC latency per HTTP request, in ms")
+    parser.add_argument('--rpc-jitter', type=float, default=10, help="extra random mock RPC latency, in ms")
+    parser.add_argument('--history-size', type=int, default=1000, help="transactions kept per address by the mock RPC")
+    parser.add_argument('--redis-url', help="use this Redis instead of an in-process fakeredis")
+    parser.add_argument('--respect-rate-limits', action='store_true', help="keep the server's default rate limits")
+    parser.add_argument('--skip-vending', action='store_true')
+    parser.add_argument('--skip-atm', action='store_true')
+    parser.add_argument('--output', help="also write the results as JSON to this file")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.output:
+        arguments.output = os.path.abspath(arguments.output)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(main(arguments))
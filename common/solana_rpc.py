@@ -0,0 +1,223 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Statuses that mean "try another endpoint" rather than "the request is wrong"
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class RpcError(Exception):
+    def __init__(self, method: str, error: Dict[str, Any]):
+        self.method = method
+        self.code = error.get('code')
+        super().__init__(f"{method} failed: {error.get('message', error)}")
+
+class RpcEndpointError(Exception):
+    pass
+
+class RpcEndpoint:
+    def __init__(self, url: str, cooldown: float, max_cooldown: float):
+        self.url = url
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.latency = float('inf')  # EWMA of successful round trips, in seconds; unmeasured sorts last
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def record_success(self, latency: float) -> None:
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.latency = latency if self.latency == float('inf') else 0.8 * self.latency + 0.2 * latency
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        backoff = min(self.max_cooldown, self.cooldown * 2 ** (self.failures - 1))
+        self.unhealthy_until = time.monotonic() + backoff
+
+# Solana JSON-RPC client shared by the vending and ATM servers. Calls made in the
+# same short window are coalesced into a single JSON-RPC batch request, identical
+# calls already in flight share one result, connections are pooled, and requests
+# fail over across the configured endpoints in order, with healthy endpoints that
+# have been measured reordered fastest first.
+#
+# Results are returned as decoded JSON and may be shared between callers, so treat
+# them as read-only. If given, `observer(method, seconds, ok)` is called for every
+# call actually sent to an endpoint, with the round trip of the request carrying it.
+class SolanaRpcClient:
+    def __init__(self, endpoints: List[str], max_batch_size: int = 50, batch_window: float = 0.002,
+                 timeout: float = 10, pool_size: int = 20, cooldown: float = 5, max_cooldown: float = 120,
+                 max_concurrent_sends: int = 4, observer: Optional[Callable[[str, float, bool], None]] = None):
+        if not endpoints:
+            raise ValueError("At least one RPC endpoint is required")
+        self.endpoints = [RpcEndpoint(url, cooldown, max_cooldown) for url in endpoints]
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_concurrent_sends = max_concurrent_sends
+        self.observer = observer
+        # Created on first use so it binds to the loop the client actually runs on
+        self.send_semaphore: Optional[asyncio.Semaphore] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.pending: List[Tuple[str, list, asyncio.Future]] = []
+        self.inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.send_tasks = set()
+
+    async def close(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.send_tasks:
+            await asyncio.gather(*self.send_tasks, return_exceptions=True)
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def call(self, method: str, params: Optional[list] = None) -> Any:
+        params = params or []
+        key = (method, json.dumps(params, sort_keys=True))
+
+        # Single-flight: identical requests already in flight share one result
+        future = self.inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+            self.pending.append((method, params, future))
+            if len(self.pending) >= self.max_batch_size:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.batch_window, self.flush)
+
+        # Shielded so one cancelled caller does not fail everyone sharing the call
+        return await asyncio.shield(future)
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            if self.send_semaphore is None:
+                self.send_semaphore = asyncio.Semaphore(self.max_concurrent_sends)
+            task = asyncio.ensure_future(self.send(batch))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+    async def send(self, batch: List[Tuple[str, list, asyncio.Future]]) -> None:
+        requests = [
+            {'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params}
+            for i, (method, params, _) in enumerate(batch)
+        ]
+        try:
+            # Large bursts (e.g. a cold-start backfill) are split into many batches; only a
+            # few go out at once so they do not all land on the provider's rate limit together
+            async with self.send_semaphore:
+                started = time.monotonic()
+                try:
+                    # A lone call goes out as a plain request; some providers meter batches separately
+                    if len(requests) == 1:
+                        responses = [await self.post(requests[0])]
+                    else:
+                        responses = await self.post(requests)
+                    # Some providers reject a whole batch with a single error object
+                    if not isinstance(responses, list):
+                        error = responses.get('error') if isinstance(responses, dict) else None
+                        raise RpcError('batch', error if isinstance(error, dict) else {'message': 'malformed batch response'})
+                except Exception:
+                    for method, _, _ in batch:
+                        self.observe(method, started, False)
+                    raise
+
+            by_id = {response.get('id'): response for response in responses if isinstance(response, dict)}
+            for i, (method, _, future) in enumerate(batch):
+                response = by_id.get(i)
+                ok = response is not None and 'error' not in response
+                self.observe(method, started, ok)
+                if future.done():
+                    continue
+                if response is None:
+                    future.set_exception(RpcError(method, {'message': 'missing response in batch'}))
+                elif 'error' in response:
+                    future.set_exception(RpcError(method, response['error']))
+                else:
+                    future.set_result(response.get('result'))
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Never leave a caller, or the single-flight entry it holds, waiting forever
+            for _, _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+    def observe(self, method: str, started: float, ok: bool) -> None:
+        if self.observer is None:
+            return
+        try:
+            self.observer(method, time.monotonic() - started, ok)
+        except Exception as e:
+            logger.warning(f"RPC observer failed: {e!r}")
+
+    def route(self) -> List[RpcEndpoint]:
+        # Healthy endpoints by observed latency, then the ones cooling down as a last resort.
+        # The sort is stable, so unmeasured endpoints keep their configured order
+        return sorted(self.endpoints, key=lambda e: (not e.healthy, e.latency))
+
+    async def post(self, payload: Any) -> Any:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+        last_error: Optional[Exception] = None
+        for endpoint in self.route():
+            started = time.monotonic()
+            try:
+                async with self.session.post(endpoint.url, json=payload) as response:
+                    if response.status in RETRYABLE_STATUSES:
+                        raise RpcEndpointError(f"{endpoint.url} returned {response.status}")
+                    response.raise_for_status()
+                    data = await response.json()
+                endpoint.record_success(time.monotonic() - started)
+                return data
+            except (aiohttp.ClientError, asyncio.TimeoutError, RpcEndpointError) as e:
+                endpoint.record_failure()
+                logger.warning(f"RPC endpoint {endpoint.url} failed: {e!r}")
+                last_error = e
+        raise last_error
+
+    async def get_signatures_for_address(self, address: str, before: Optional[str] = None,
+                                         until: Optional[str] = None, limit: Optional[int] = None,
+                                         commitment: str = 'confirmed') -> List[Dict[str, Any]]:
+        options: Dict[str, Any] = {'commitment': commitment}
+        if before:
+            options['before'] = before
+        if until:
+            options['until'] = until
+        if limit:
+            options['limit'] = limit
+        return await self.call('getSignaturesForAddress', [address, options])
+
+    async def get_transaction(self, signature: str, commitment: str = 'confirmed') -> Optional[Dict[str, Any]]:
+        return await self.call('getTransaction', [signature, {
+            'commitment': commitment,
+            'encoding': 'json',
+            'maxSupportedTransactionVersion': 0
+        }])
+
+    async def get_transactions(self, signatures: List[str], commitment: str = 'confirmed') -> List[Optional[Dict[str, Any]]]:
+        # Issued together, these are coalesced into batch requests
+        return await asyncio.gather(*(self.get_transaction(signature, commitment) for signature in signatures))
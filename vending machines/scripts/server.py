@@ -1,25 +1,30 @@
 import os
+import io
+import hashlib
 import json
+import math
+import time
 import asyncio
+import contextlib
 import logging
+import multiprocessing
+import signal
+import socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, Awaitable, Callable, Iterator, List, Optional, Set
 from aiohttp import web
-from solana.rpc.async_api import AsyncClient
-from solana.transaction import Transaction
-from solana.system_program import TransferParams, transfer
-from solana.keypair import Keypair
-from solana.publickey import PublicKey
-import qrcode
-from base58 import b58encode, b58decode
-from cryptography.fernet import Fernet
+from base58 import b58encode
 import aioredis
-from aiolimiter import AsyncLimiter
 import sentry_sdk
-from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 from prometheus_client import Counter, Histogram
-from prometheus_async.aio.web import server_stats
 import ssl
+import sys
+
+# The Solana RPC client is shared with the ATM server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+from solana_rpc import SolanaRpcClient
 
 # Configuration
 CONFIG_FILE = os.getenv("CONFIG_FILE", "server_config.json")
@@ -34,6 +39,10 @@ class Config:
         self.port: int = config['port']
         self.host: str = config['host']
         self.solana_network: str = config['solana_network']
+        # Extra endpoints to fail over to; the primary network endpoint is tried first
+        # unless a fallback has since been measured faster
+        self.solana_rpc_endpoints: List[str] = [self.solana_network] + config.get('solana_rpc_fallbacks', [])
+        self.rpc_max_batch_size: int = config.get('rpc_max_batch_size', 50)
         self.merchant_wallet: str = config['merchant_wallet']
         self.merchant_private_key: str = config['merchant_private_key']
         self.api_key: str = config['api_key']
@@ -42,73 +51,513 @@ class Config:
         self.sentry_dsn: str = config['sentry_dsn']
         self.ssl_cert: str = config['ssl_cert']
         self.ssl_key: str = config['ssl_key']
+        self.watcher_interval: float = config.get('watcher_interval', 2.0)
+        self.watcher_page_size: int = config.get('watcher_page_size', 1000)
+        self.watcher_missing_timeout: float = config.get('watcher_missing_timeout', 300)
+        self.long_poll_timeout: float = config.get('long_poll_timeout', 25.0)
+        self.qr_storage: str = config.get('qr_storage', 'memory')  # 'memory' or 'disk'
+        self.qr_cache_size: int = config.get('qr_cache_size', 1024)
+        self.qr_cache_ttl: float = config.get('qr_cache_ttl', 3600)
+        self.crypto_workers: int = config.get('crypto_workers', 4)
+        self.cleanup_interval: float = config.get('cleanup_interval', 60)
+        self.cleanup_batch_size: int = config.get('cleanup_batch_size', 500)
+        self.rate_limits: Dict[str, Dict[str, float]] = config.get('rate_limits', {})
+        # Each API key also gets an aggregate budget of this many machines' worth, so
+        # varying the Machine-Id header cannot get around the per-machine budgets
+        self.machines_per_api_key: float = config.get('machines_per_api_key', 20)
+        self.workers: int = config.get('workers', 1)
+        self.max_payment_batch: int = config.get('max_payment_batch', 20)
+        self.max_status_batch: int = config.get('max_status_batch', 1000)
+        self.max_inventory_batch: int = config.get('max_inventory_batch', 1000)
+        self.lease_ttl: float = config.get('lease_ttl', 15)
+        # Fraction of requests traced while traffic is low, and the cap on traces per
+        # second the sampler scales that fraction down to under load
+        self.traces_sample_rate: float = config.get('traces_sample_rate', 0.1)
+        self.max_traces_per_second: float = config.get('max_traces_per_second', 5)
 
-config = Config(CONFIG_FILE)
+# Nothing is loaded at import time: create_app reads the config, and connections,
+# thread pools and anything else that must not be shared across a fork are created
+# per worker process in init_resources.
+config: Optional[Config] = None
+fernet = None
+ready = False
+solana_rpc: Optional[SolanaRpcClient] = None
+redis: Optional[aioredis.Redis] = None
+crypto_executor: Optional[ThreadPoolExecutor] = None
 
-# Initialize Sentry
-sentry_sdk.init(
-    dsn=config.sentry_dsn,
-    integrations=[AioHttpIntegration()],
-    traces_sample_rate=1.0
-)
+# Per-machine token bucket budgets per endpoint: requests per second and burst size
+DEFAULT_RATE_LIMITS = {
+    'generate_payment': {'rate': 2, 'burst': 5},
+    # Machines refill every slot's payment pool at startup, one request per slot
+    'generate_payments': {'rate': 0.5, 'burst': 20},
+    'verify_payment': {'rate': 5, 'burst': 10},
+    'wait_payment': {'rate': 1, 'burst': 3},
+    'transaction_status': {'rate': 20, 'burst': 40},
+    # Charged per STATUS_BATCH_CHUNK memos
+    'transaction_status_batch': {'rate': 2, 'burst': 20},
+    'qr_code': {'rate': 5, 'burst': 10},
+    'inventory_sync': {'rate': 1, 'burst': 5},
+    'inventory': {'rate': 2, 'burst': 5},
+}
+
+# Lease renewal and release must only touch the lease if we still hold it
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
 
-# Initialize Solana client
-solana_client = AsyncClient(config.solana_network)
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
-# Initialize Redis client
-redis = aioredis.from_url(config.redis_url, decode_responses=True)
+# Applies a machine's stock updates, skipping any at or below the highest update id
+# already applied from the same local store, so retried or regrown batches apply each
+# update once. KEYS: stock hash, applied-id hash. ARGV: store id, then id/slot/quantity
+# triples in ascending id order. Returns the number of updates applied.
+INVENTORY_SYNC_SCRIPT = """
+local last = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+local applied = 0
+for i = 2, #ARGV, 3 do
+    local id = tonumber(ARGV[i])
+    if id > last then
+        redis.call('HSET', KEYS[1], ARGV[i + 1], ARGV[i + 2])
+        last = id
+        applied = applied + 1
+    end
+end
+redis.call('HSET', KEYS[2], ARGV[1], last)
+return applied
+"""
 
-# Initialize Fernet for encryption
-fernet = Fernet(config.encryption_key)
+# Refills each bucket for the elapsed time and takes `cost` tokens from all of them
+# if every one has enough, so a request denied by one budget is not charged to another.
+# KEYS: the buckets. ARGV: now, cost, then rate and burst per bucket.
+# Returns {allowed, seconds until enough tokens are available in every bucket}.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local tokens = {}
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local burst = tonumber(ARGV[2 + 2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    available = math.min(burst, available + math.max(0, now - ts) * rate)
+    if available < cost then
+        retry_after = math.max(retry_after, (cost - available) / rate)
+    end
+    tokens[i] = available
+end
+local allowed = 0
+if retry_after == 0 then
+    allowed = 1
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local burst = tonumber(ARGV[2 + 2 * i])
+    if allowed == 1 then
+        tokens[i] = tokens[i] - cost
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return {allowed, tostring(retry_after)}
+"""
 
-# Initialize rate limiter
-rate_limiter = AsyncLimiter(10, 1)  # 10 requests per second
+LAMPORTS_PER_SOL = 1_000_000_000
+SYSTEM_PROGRAM_ID = "11111111111111111111111111111111"
+PAYMENT_TTL = 3600
+STATUS_BATCH_CHUNK = 100
+WATCHER_CURSOR_KEY = "payment_watcher:cursor"
+PAYMENT_CHANNEL = "payments"
+TRANSACTION_EXPIRY_KEY = "transactions:expiry"
+INVENTORY_MACHINES_KEY = "inventory:machines"
 
 # Prometheus metrics
 REQUESTS = Counter('server_requests_total', 'Total number of requests', ['endpoint'])
 LATENCY = Histogram('server_request_latency_seconds', 'Request latency in seconds', ['endpoint'])
+STAGE_LATENCY = Histogram(
+    'server_stage_latency_seconds', 'Latency of hot-path stages (Redis, Fernet, QR render) in seconds', ['stage'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+)
+RPC_CALLS = Counter('server_rpc_calls_total', 'Solana RPC calls sent', ['method', 'result'])
+RPC_LATENCY = Histogram('server_rpc_latency_seconds', 'Solana RPC round trip in seconds', ['method'])
+# RPC calls per verified payment is server_rpc_calls_total / server_payments_verified_total
+PAYMENTS_VERIFIED = Counter('server_payments_verified_total', 'Payments verified')
+RATE_LIMITED = Counter('server_rate_limited_total', 'Requests rejected by the rate limiter', ['endpoint'])
+RATE_LIMIT_RETRY_AFTER = Histogram(
+    'server_rate_limit_retry_after_seconds', 'Wait imposed on rate limited requests in seconds', ['endpoint']
+)
+CACHE_LOOKUPS = Counter('server_cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    # Times one stage of a request as a histogram sample and, when traced, a Sentry span
+    with sentry_sdk.start_span(op=name.split('.')[0], description=name), STAGE_LATENCY.labels(name).time():
+        yield
+
+def observe_rpc_call(method: str, seconds: float, ok: bool) -> None:
+    RPC_CALLS.labels(method, 'ok' if ok else 'error').inc()
+    RPC_LATENCY.labels(method).observe(seconds)
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+# Sentry traces_sampler that keeps tracing cheap under load: it samples at the
+# configured rate while traffic is light and scales the rate down so that no more
+# than max_per_second traces are started on average. Metrics scrapes and readiness
+# probes are never traced.
+class TraceSampler:
+    def __init__(self, sample_rate: float, max_per_second: float):
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.rate = sample_rate
+        self.window_start = time.monotonic()
+        self.seen = 0
+
+    def __call__(self, sampling_context: Dict[str, Any]) -> float:
+        if sampling_context.get('parent_sampled') is not None:
+            return float(sampling_context['parent_sampled'])
+        request = sampling_context.get('aiohttp_request')
+        if request is not None and request.path in ('/metrics', '/ready'):
+            return 0.0
+
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            observed = self.seen / elapsed
+            self.rate = min(self.sample_rate, self.max_per_second / observed) if observed else self.sample_rate
+            self.window_start = now
+            self.seen = 0
+        self.seen += 1
+        return self.rate
+
+def sol_to_lamports(amount: float) -> int:
+    return int(round(float(amount) * LAMPORTS_PER_SOL))
+
+# Follows the merchant wallet once for the whole fleet and indexes every incoming
+# payment by its Solana Pay reference keys, so verify_payment is a single lookup.
+class PaymentWatcher:
+    def __init__(self, merchant_wallet: str, interval: float, page_size: int, missing_timeout: float):
+        self.merchant_wallet = merchant_wallet
+        self.interval = interval
+        self.page_size = page_size
+        self.missing_timeout = missing_timeout
+        # Signatures the RPC node listed but could not return yet, with when we first saw them
+        self.missing: Dict[str, float] = {}
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.poll()
+                await asyncio.sleep(self.interval)
+            except Exception as e:
+                logger.error(f"Error in payment watcher: {str(e)}", exc_info=True)
+                sentry_sdk.capture_exception(e)
+                await asyncio.sleep(self.interval)
+
+    async def poll(self) -> None:
+        with sentry_sdk.start_transaction(op='task', name='payment_watcher.poll'):
+            await self.poll_signatures()
+
+    async def poll_signatures(self) -> None:
+        with stage('redis.get'):
+            until = await redis.get(WATCHER_CURSOR_KEY)
+
+        # Page backwards from the newest signature until we reach the cursor
+        signatures = []
+        before = None
+        while True:
+            with sentry_sdk.start_span(op='rpc', description='getSignaturesForAddress'):
+                page = await solana_rpc.get_signatures_for_address(
+                    self.merchant_wallet, before=before, until=until, limit=self.page_size
+                )
+            signatures.extend(page)
+            if until is None or len(page) < self.page_size:
+                break
+            before = page[-1]['signature']
+
+        if not signatures:
+            return
+        if until is None:
+            # Cold start: only payments that can still be pending matter. The newest signature
+            # is always kept so the cursor gets set.
+            oldest = time.time() - PAYMENT_TTL
+            signatures = [status for status in signatures if (status.get('blockTime') or oldest) >= oldest] or signatures[:1]
+
+        # Fetch every new transaction at once; the RPC client batches the requests
+        successful = [status['signature'] for status in reversed(signatures) if status.get('err') is None]
+        with sentry_sdk.start_span(op='rpc', description='getTransaction'):
+            transactions = dict(zip(successful, await solana_rpc.get_transactions(successful)))
+
+        # Index oldest first. A lagging node may list a signature it cannot return yet;
+        # the cursor stops just before the oldest such gap so it is fetched again on the
+        # next poll, while newer payments are still indexed now (indexing is idempotent).
+        cursor = None
+        gap = False
+        for status in reversed(signatures):
+            signature = status['signature']
+            if signature in transactions and transactions[signature] is None:
+                if self.transaction_pending(signature):
+                    gap = True
+                    continue
+            elif signature in transactions:
+                self.missing.pop(signature, None)
+                await self.index_transaction(signature, transactions[signature])
+            if not gap:
+                cursor = signature
+        if cursor is not None:
+            with stage('redis.set'):
+                await redis.set(WATCHER_CURSOR_KEY, cursor)
+
+    def transaction_pending(self, signature: str) -> bool:
+        # Keeps retrying a missing transaction until missing_timeout, then skips it so
+        # one unfetchable signature cannot pin the cursor forever
+        first_seen = self.missing.setdefault(signature, time.monotonic())
+        if time.monotonic() - first_seen < self.missing_timeout:
+            return True
+        del self.missing[signature]
+        logger.error(f"Giving up on transaction {signature}: not returned by RPC for {self.missing_timeout}s")
+        sentry_sdk.capture_message(f"Payment watcher skipped unfetchable transaction {signature}")
+        return False
+
+    async def index_transaction(self, signature: str, transaction: Optional[Dict[str, Any]]) -> None:
+        if transaction is None:
+            return
+        meta = transaction.get('meta')
+        if meta is None or meta.get('err') is not None:
+            return
+
+        message = transaction['transaction']['message']
+        account_keys = message['accountKeys']
+        if self.merchant_wallet not in account_keys:
+            return
+        index = account_keys.index(self.merchant_wallet)
+        lamports = meta['postBalances'][index] - meta['preBalances'][index]
+        if lamports <= 0:
+            return
+
+        # Solana Pay references are the extra accounts on the System Program transfer to
+        # the merchant; program ids and other instructions' accounts are not references.
+        # Instructions of versioned transactions may also index lookup-table addresses.
+        loaded = meta.get('loadedAddresses') or {}
+        keys = account_keys + loaded.get('writable', []) + loaded.get('readonly', [])
+        references = set()
+        for instruction in message.get('instructions', []):
+            if keys[instruction['programIdIndex']] != SYSTEM_PROGRAM_ID:
+                continue
+            accounts = [keys[i] for i in instruction['accounts']]
+            if len(accounts) > 2 and accounts[1] == self.merchant_wallet:
+                references.update(accounts[2:])
+        references.discard(self.merchant_wallet)
+        if not references:
+            return
+
+        payment = json.dumps({'signature': signature, 'lamports': lamports})
+        pipe = redis.pipeline()
+        for key in references:
+            pipe.set(f"payment:{key}", payment, ex=PAYMENT_TTL)
+            pipe.publish(PAYMENT_CHANNEL, key)
+        with stage('redis.pipeline'):
+            await pipe.execute()
+
+# Wakes up long-poll requests waiting on a memo when the watcher publishes its
+# reference, whichever worker the watcher happens to run in.
+class PaymentNotifier:
+    def __init__(self):
+        self.waiters: Dict[str, Set[asyncio.Event]] = {}
+
+    @contextlib.contextmanager
+    def waiter(self, memo: str) -> Iterator[asyncio.Event]:
+        event = asyncio.Event()
+        self.waiters.setdefault(memo, set()).add(event)
+        try:
+            yield event
+        finally:
+            events = self.waiters[memo]
+            events.discard(event)
+            if not events:
+                del self.waiters[memo]
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with redis.pubsub() as pubsub:
+                    await pubsub.subscribe(PAYMENT_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message['type'] != 'message':
+                            continue
+                        for event in self.waiters.get(message['data'], ()):
+                            event.set()
+            except Exception as e:
+                logger.error(f"Error in payment notifier: {str(e)}", exc_info=True)
+                sentry_sdk.capture_exception(e)
+                await asyncio.sleep(1)
+
+payment_notifier = PaymentNotifier()
+
+# Token buckets held in Redis, keyed per endpoint, so every server worker enforces
+# the same budgets and cheap reads never wait behind slow calls. A request is charged
+# to its machine's bucket and to the aggregate bucket of its API key.
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Dict[str, float]], machines_per_api_key: float):
+        self.limits = limits
+        self.machines_per_api_key = machines_per_api_key
+        self.script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def acquire(self, api_key_id: str, machine_id: str, endpoint: str, cost: float = 1) -> float:
+        limit = self.limits[endpoint]
+        scale = self.machines_per_api_key
+        with stage('redis.rate_limit'):
+            allowed, retry_after = await self.script(
+                keys=[f"ratelimit:{endpoint}:{api_key_id}:{machine_id}", f"ratelimit:{endpoint}:{api_key_id}"],
+                args=[time.time(), cost,
+                      limit['rate'], limit['burst'],
+                      limit['rate'] * scale, limit['burst'] * scale]
+            )
+        return 0.0 if int(allowed) else float(retry_after)
+
+rate_limiter: Optional[RateLimiter] = None
+inventory_sync_script = None
+
+def api_key_id(request: web.Request) -> str:
+    # The key is hashed so it never appears in Redis key names
+    return hashlib.sha256((request.headers.get('API-Key') or '').encode()).hexdigest()[:12]
+
+def machine_id(request: web.Request) -> str:
+    # Client-supplied, so only trusted to split an API key's budget between machines
+    return request.headers.get('Machine-Id') or request.remote
+
+async def throttle(request: web.Request, endpoint: str, cost: float = 1) -> Optional[web.Response]:
+    retry_after = await rate_limiter.acquire(api_key_id(request), machine_id(request), endpoint, cost)
+    if not retry_after:
+        return None
+    RATE_LIMITED.labels(endpoint).inc()
+    RATE_LIMIT_RETRY_AFTER.labels(endpoint).observe(retry_after)
+    logger.warning(f"Rate limit exceeded on {endpoint} for {api_key_id(request)}:{machine_id(request)}")
+    return web.json_response(
+        {'error': 'Too many requests'},
+        status=429,
+        headers={'Retry-After': str(max(1, math.ceil(retry_after)))}
+    )
+
+# Small bounded cache whose entries also expire after a fixed TTL
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+qr_cache: Optional[TTLCache] = None
+
+def encode_record(record: Dict[str, Any]) -> str:
+    return fernet.encrypt(json.dumps(record, separators=(',', ':')).encode()).decode('ascii')
+
+def decode_record(token: str) -> Dict[str, Any]:
+    return json.loads(fernet.decrypt(token.encode('ascii')))
+
+async def encrypt_record(record: Dict[str, Any]) -> str:
+    with stage('fernet.encrypt'):
+        return await asyncio.get_running_loop().run_in_executor(crypto_executor, encode_record, record)
+
+async def decrypt_record(token: str) -> Dict[str, Any]:
+    with stage('fernet.decrypt'):
+        return await asyncio.get_running_loop().run_in_executor(crypto_executor, decode_record, token)
+
+def build_payment_url(recipient_wallet: str, item_price: float, item_slot: str, memo: str) -> str:
+    return f"solana:{recipient_wallet}?amount={item_price}&reference={memo}&label=Vending%20Machine&message=Payment%20for%20item%20{item_slot}"
+
+def render_qr_png(payment_url: str) -> bytes:
+    import qrcode  # Pulls in PIL; deferred until the first render
+
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(payment_url)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+async def render_qr(payment_url: str) -> bytes:
+    # PNG encoding is CPU-bound; keep it off the event loop
+    with stage('qr.render'):
+        return await asyncio.get_running_loop().run_in_executor(None, render_qr_png, payment_url)
+
+def write_file(path: str, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+async def issue_payment(item_price: float, recipient_wallet: str, item_slot: str) -> Dict[str, Any]:
+    # Generate a unique memo for this transaction. It doubles as the Solana Pay
+    # reference, so it must be a valid 32-byte public key.
+    memo = b58encode(os.urandom(32)).decode('ascii')
+
+    # Create a Solana payment URL
+    payment_url = build_payment_url(recipient_wallet, item_price, item_slot, memo)
+
+    # Generate QR code off the event loop and keep it in memory
+    qr_png = await render_qr(payment_url)
+    qr_cache.set(memo, qr_png)
+    payment = {
+        'payment_url': payment_url,
+        'qr_code_url': f"/qr/{memo}",
+        'memo': memo,
+        'expires_at': int(time.time() + PAYMENT_TTL)
+    }
+
+    # Optionally also persist the QR code to disk
+    if config.qr_storage == 'disk':
+        qr_code_path = f"qr_codes/{memo}.png"
+        await asyncio.get_running_loop().run_in_executor(None, write_file, qr_code_path, qr_png)
+        payment['qr_code_path'] = qr_code_path
+
+    # Store transaction details in Redis
+    await store_transaction(memo, {
+        'item_price': item_price,
+        'recipient_wallet': recipient_wallet,
+        'item_slot': item_slot,
+        'created_at': datetime.utcnow().isoformat()
+    })
+    return payment
 
 async def generate_payment(request: web.Request) -> web.Response:
-    async with LATENCY.labels('generate_payment').time():
+    with LATENCY.labels('generate_payment').time():
         REQUESTS.labels('generate_payment').inc()
         try:
-            async with rate_limiter:
-                data = await request.json()
-                item_price = data['item_price']
-                recipient_wallet = data['recipient_wallet']
-                item_slot = data['item_slot']
-
-                # Generate a unique memo for this transaction
-                memo = b58encode(os.urandom(16)).decode('ascii')
-
-                # Create a Solana payment URL
-                payment_url = f"solana:{recipient_wallet}?amount={item_price}&reference={memo}&label=Vending%20Machine&message=Payment%20for%20item%20{item_slot}"
-
-                # Generate QR code
-                qr = qrcode.QRCode(version=1, box_size=10, border=5)
-                qr.add_data(payment_url)
-                qr.make(fit=True)
-                img = qr.make_image(fill_color="black", back_color="white")
-                
-                # Save QR code
-                qr_code_path = f"qr_codes/{memo}.png"
-                img.save(qr_code_path)
-
-                # Store transaction details in Redis
-                encrypted_details = fernet.encrypt(json.dumps({
-                    'item_price': item_price,
-                    'recipient_wallet': recipient_wallet,
-                    'item_slot': item_slot,
-                    'status': 'pending',
-                    'created_at': datetime.utcnow().isoformat()
-                }).encode())
-                await redis.set(f"transaction:{memo}", encrypted_details, ex=3600)  # Expire after 1 hour
-
-                return web.json_response({
-                    'payment_url': payment_url,
-                    'qr_code_path': qr_code_path,
-                    'memo': memo
-                })
+            throttled = await throttle(request, 'generate_payment')
+            if throttled:
+                return throttled
+
+            data = await request.json()
+            payment = await issue_payment(data['item_price'], data['recipient_wallet'], data['item_slot'])
+            return web.json_response(payment)
 
         except ValueError as ve:
             logger.warning(f"Invalid input: {str(ve)}")
@@ -118,46 +567,99 @@ async def generate_payment(request: web.Request) -> web.Response:
             sentry_sdk.capture_exception(e)
             return web.json_response({'error': 'Internal server error'}, status=500)
 
+# Transaction records are Redis hashes: a plaintext `status` that status reads can
+# use directly, and an encrypted `payload` holding the transaction details.
+async def store_transaction(memo: str, details: Dict[str, Any]) -> None:
+    payload = await encrypt_record(details)
+    pipe = redis.pipeline()
+    pipe.hset(f"transaction:{memo}", mapping={'status': 'pending', 'payload': payload})
+    pipe.expire(f"transaction:{memo}", PAYMENT_TTL)  # Expire after 1 hour
+    pipe.zadd(TRANSACTION_EXPIRY_KEY, {memo: time.time() + PAYMENT_TTL})
+    with stage('redis.pipeline'):
+        await pipe.execute()
+
+async def load_transaction(memo: str) -> Optional[Dict[str, Any]]:
+    with stage('redis.hget'):
+        payload = await redis.hget(f"transaction:{memo}", 'payload')
+    if not payload:
+        return None
+    return await decrypt_record(payload)
+
+async def generate_payments(request: web.Request) -> web.Response:
+    with LATENCY.labels('generate_payments').time():
+        REQUESTS.labels('generate_payments').inc()
+        try:
+            throttled = await throttle(request, 'generate_payments')
+            if throttled:
+                return throttled
+
+            # Issues several references for the same item in one call, so machines can
+            # keep a pool ready before a customer makes a selection
+            data = await request.json()
+            count = int(data.get('count', 1))
+            if not 1 <= count <= config.max_payment_batch:
+                return web.json_response({'error': f"count must be between 1 and {config.max_payment_batch}"}, status=400)
+
+            payments = await asyncio.gather(*(
+                issue_payment(data['item_price'], data['recipient_wallet'], data['item_slot'])
+                for _ in range(count)
+            ))
+            return web.json_response({'payments': payments})
+
+        except (KeyError, ValueError) as ve:
+            logger.warning(f"Invalid input: {str(ve)}")
+            return web.json_response({'error': 'Invalid input'}, status=400)
+        except Exception as e:
+            logger.error(f"Error generating payments: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+async def resolve_payment_status(memo: str) -> str:
+    with stage('redis.hget'):
+        status = await redis.hget(f"transaction:{memo}", 'status')
+    if status is None:
+        return 'not_found'
+    if status == 'verified':
+        return 'verified'
+
+    # Look up the payment indexed by the watcher under this reference
+    with stage('redis.get'):
+        payment = await redis.get(f"payment:{memo}")
+    if not payment:
+        return 'not_verified'
+    payment = json.loads(payment)
+
+    transaction_details = await load_transaction(memo)
+    if transaction_details is None:
+        return 'not_found'
+    if payment['lamports'] < sol_to_lamports(transaction_details['item_price']):
+        return 'not_verified'
+
+    # Update transaction status in Redis
+    verification = await encrypt_record({
+        'signature': payment['signature'],
+        'verified_at': datetime.utcnow().isoformat()
+    })
+    pipe = redis.pipeline()
+    pipe.hset(f"transaction:{memo}", mapping={'status': 'verified', 'verification': verification})
+    pipe.expire(f"transaction:{memo}", PAYMENT_TTL)
+    pipe.zadd(TRANSACTION_EXPIRY_KEY, {memo: time.time() + PAYMENT_TTL})
+    with stage('redis.pipeline'):
+        await pipe.execute()
+    PAYMENTS_VERIFIED.inc()
+    return 'verified'
+
 async def verify_payment(request: web.Request) -> web.Response:
-    async with LATENCY.labels('verify_payment').time():
+    with LATENCY.labels('verify_payment').time():
         REQUESTS.labels('verify_payment').inc()
         try:
-            async with rate_limiter:
-                data = await request.json()
-                memo = data['memo']
-
-                # Retrieve transaction details from Redis
-                encrypted_details = await redis.get(f"transaction:{memo}")
-                if not encrypted_details:
-                    return web.json_response({'status': 'not_found'})
-
-                transaction_details = json.loads(fernet.decrypt(encrypted_details))
-
-                # Check for the transaction on the Solana blockchain
-                recent_blockhash = await solana_client.is_connected()
-                
-                # Search for the transaction with the given memo
-                transactions = await solana_client.get_signatures_for_address(PublicKey(config.merchant_wallet))
-                
-                is_verified = False
-                for tx in transactions:
-                    transaction = await solana_client.get_confirmed_transaction(tx.signature)
-                    if transaction and transaction.transaction.message.recent_blockhash == recent_blockhash:
-                        # Check if the transaction amount matches the item price and memo
-                        if (transaction.transaction.message.instructions[0].data == transaction_details['item_price'] and
-                            transaction.transaction.message.instructions[1].data == memo):
-                            is_verified = True
-                            break
-
-                if is_verified:
-                    # Update transaction status in Redis
-                    transaction_details['status'] = 'verified'
-                    transaction_details['verified_at'] = datetime.utcnow().isoformat()
-                    encrypted_details = fernet.encrypt(json.dumps(transaction_details).encode())
-                    await redis.set(f"transaction:{memo}", encrypted_details, ex=3600)
-                    return web.json_response({'status': 'verified'})
-                else:
-                    return web.json_response({'status': 'not_verified'})
+            throttled = await throttle(request, 'verify_payment')
+            if throttled:
+                return throttled
+
+            data = await request.json()
+            memo = data['memo']
+            return web.json_response({'status': await resolve_payment_status(memo)})
 
         except ValueError as ve:
             logger.warning(f"Invalid input: {str(ve)}")
@@ -167,63 +669,460 @@ async def verify_payment(request: web.Request) -> web.Response:
             sentry_sdk.capture_exception(e)
             return web.json_response({'error': 'Internal server error'}, status=500)
 
+async def wait_payment(request: web.Request) -> web.Response:
+    with LATENCY.labels('wait_payment').time():
+        REQUESTS.labels('wait_payment').inc()
+        try:
+            throttled = await throttle(request, 'wait_payment')
+            if throttled:
+                return throttled
+
+            data = await request.json()
+            memo = data['memo']
+            timeout = min(float(data.get('timeout', config.long_poll_timeout)), config.long_poll_timeout)
+
+            # Register before the first check so a payment indexed in between is not missed
+            with payment_notifier.waiter(memo) as event:
+                status = await resolve_payment_status(memo)
+                if status == 'not_verified':
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(event.wait(), timeout)
+                    status = await resolve_payment_status(memo)
+            return web.json_response({'status': status})
+
+        except (KeyError, ValueError) as ve:
+            logger.warning(f"Invalid input: {str(ve)}")
+            return web.json_response({'error': 'Invalid input'}, status=400)
+        except Exception as e:
+            logger.error(f"Error waiting for payment: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
 async def get_transaction_status(request: web.Request) -> web.Response:
-    async with LATENCY.labels('transaction_status').time():
+    with LATENCY.labels('transaction_status').time():
         REQUESTS.labels('transaction_status').inc()
         try:
-            async with rate_limiter:
-                memo = request.query.get('memo')
-                if not memo:
-                    return web.json_response({'error': 'Memo is required'}, status=400)
+            throttled = await throttle(request, 'transaction_status')
+            if throttled:
+                return throttled
 
-                encrypted_details = await redis.get(f"transaction:{memo}")
-                if not encrypted_details:
-                    return web.json_response({'status': 'not_found'})
+            memo = request.query.get('memo')
+            if not memo:
+                return web.json_response({'error': 'Memo is required'}, status=400)
 
-                transaction_details = json.loads(fernet.decrypt(encrypted_details))
-                return web.json_response({'status': transaction_details['status']})
+            # The status field is stored in plaintext, so no decryption is needed here
+            with stage('redis.hget'):
+                status = await redis.hget(f"transaction:{memo}", 'status')
+            return web.json_response({'status': status or 'not_found'})
 
         except Exception as e:
             logger.error(f"Error getting transaction status: {str(e)}", exc_info=True)
             sentry_sdk.capture_exception(e)
             return web.json_response({'error': 'Internal server error'}, status=500)
 
+async def get_transaction_statuses(request: web.Request) -> web.StreamResponse:
+    with LATENCY.labels('transaction_status_batch').time():
+        REQUESTS.labels('transaction_status_batch').inc()
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        try:
+            data = await request.json()
+            memos = data['memos']
+            if not isinstance(memos, list) or not all(isinstance(memo, str) for memo in memos):
+                raise ValueError("memos must be a list of strings")
+            if not 1 <= len(memos) <= config.max_status_batch:
+                return web.json_response({'error': f"memos must hold between 1 and {config.max_status_batch} entries"}, status=400)
+
+            throttled = await throttle(request, 'transaction_status_batch', math.ceil(len(memos) / STATUS_BATCH_CHUNK))
+            if throttled:
+                return throttled
+
+            # One pipelined round trip per chunk, streamed as NDJSON lines as each chunk
+            # resolves, so neither side holds the whole result for large batches
+            await response.prepare(request)
+            for start in range(0, len(memos), STATUS_BATCH_CHUNK):
+                chunk = memos[start:start + STATUS_BATCH_CHUNK]
+                pipe = redis.pipeline()
+                for memo in chunk:
+                    pipe.hget(f"transaction:{memo}", 'status')
+                with stage('redis.pipeline'):
+                    statuses = await pipe.execute()
+                await response.write(''.join(
+                    json.dumps({'memo': memo, 'status': status or 'not_found'}) + '\n'
+                    for memo, status in zip(chunk, statuses)
+                ).encode())
+            await response.write_eof()
+            return response
+
+        except (KeyError, TypeError, ValueError) as ve:
+            logger.warning(f"Invalid input: {str(ve)}")
+            return web.json_response({'error': 'Invalid input'}, status=400)
+        except Exception as e:
+            logger.error(f"Error getting transaction statuses: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            if response.prepared:
+                # Headers are already sent, so report the failure as the final line
+                with contextlib.suppress(Exception):
+                    await response.write(json.dumps({'error': 'Internal server error'}).encode() + b'\n')
+                return response
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+async def get_qr_code(request: web.Request) -> web.Response:
+    with LATENCY.labels('qr_code').time():
+        REQUESTS.labels('qr_code').inc()
+        try:
+            throttled = await throttle(request, 'qr_code')
+            if throttled:
+                return throttled
+
+            memo = request.match_info['memo']
+            # A memo's QR code never changes, so the memo itself is a strong ETag
+            etag = f'"{memo}"'
+            headers = {'ETag': etag, 'Cache-Control': f"private, max-age={int(config.qr_cache_ttl)}, immutable"}
+
+            qr_png = qr_cache.get(memo)
+            record_cache_lookup('qr', qr_png is not None)
+            details = None
+            if qr_png is None:
+                # Another worker issued this memo, or the entry was evicted
+                details = await load_transaction(memo)
+                if details is None:
+                    return web.json_response({'error': 'Not found'}, status=404)
+
+            # Only a memo we know of can be answered with 304
+            not_modified = request.headers.get('If-None-Match') == etag
+            record_cache_lookup('qr_etag', not_modified)
+            if not_modified:
+                return web.Response(status=304, headers=headers)
+
+            if qr_png is None:
+                payment_url = build_payment_url(details['recipient_wallet'], details['item_price'], details['item_slot'], memo)
+                qr_png = await render_qr(payment_url)
+                qr_cache.set(memo, qr_png)
+
+            return web.Response(body=qr_png, content_type='image/png', headers=headers)
+
+        except Exception as e:
+            logger.error(f"Error serving QR code: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+async def sync_inventory(request: web.Request) -> web.Response:
+    with LATENCY.labels('inventory_sync').time():
+        REQUESTS.labels('inventory_sync').inc()
+        try:
+            throttled = await throttle(request, 'inventory_sync')
+            if throttled:
+                return throttled
+
+            data = await request.json()
+            machine_id = data['machine_id']
+            store_id = str(data['store_id'])
+            updates = sorted((int(update_id), str(slot), int(quantity)) for update_id, slot, quantity in data['updates'])
+            if not 1 <= len(updates) <= config.max_inventory_batch:
+                return web.json_response({'error': f"updates must hold between 1 and {config.max_inventory_batch} entries"}, status=400)
+
+            args = [store_id]
+            for update in updates:
+                args.extend(update)
+            applied = await inventory_sync_script(
+                keys=[f"stock:{machine_id}", f"stock:{machine_id}:applied"], args=args
+            )
+            await redis.sadd(INVENTORY_MACHINES_KEY, machine_id)
+            return web.json_response({'status': 'applied' if applied else 'duplicate', 'applied': applied})
+
+        except (KeyError, TypeError, ValueError) as ve:
+            logger.warning(f"Invalid input: {str(ve)}")
+            return web.json_response({'error': 'Invalid input'}, status=400)
+        except Exception as e:
+            logger.error(f"Error syncing inventory: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+async def get_inventory(request: web.Request) -> web.Response:
+    with LATENCY.labels('inventory').time():
+        REQUESTS.labels('inventory').inc()
+        try:
+            throttled = await throttle(request, 'inventory')
+            if throttled:
+                return throttled
+
+            machine_id = request.query.get('machine_id')
+            machine_ids = [machine_id] if machine_id else sorted(await redis.smembers(INVENTORY_MACHINES_KEY))
+
+            # Latest stock level per slot reported by each machine, read in one round trip
+            pipe = redis.pipeline()
+            for machine in machine_ids:
+                pipe.hgetall(f"stock:{machine}")
+            results = await pipe.execute()
+            return web.json_response({
+                machine: {slot: int(quantity) for slot, quantity in stock.items()}
+                for machine, stock in zip(machine_ids, results)
+            })
+
+        except Exception as e:
+            logger.error(f"Error getting inventory: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+async def readiness(request: web.Request) -> web.Response:
+    if not ready:
+        return web.json_response({'status': 'starting'}, status=503)
+    return web.json_response({'status': 'ready'})
+
+async def metrics(request: web.Request) -> web.Response:
+    from prometheus_async.aio.web import server_stats
+    return await server_stats(request)
+
 async def validate_api_key(request: web.Request, handler: callable) -> web.Response:
     if request.headers.get('API-Key') != config.api_key:
         logger.warning(f"Invalid API key attempt from IP: {request.remote}")
         return web.json_response({'error': 'Invalid API key'}, status=401)
     return await handler(request)
 
+# Only memos whose expiry is due are read from the index, in pipelined batches,
+# so the cost scales with the records expired rather than the live keyspace.
+async def expire_due_transactions() -> int:
+    expired = 0
+    while True:
+        memos = await redis.zrangebyscore(
+            TRANSACTION_EXPIRY_KEY, '-inf', time.time(), start=0, num=config.cleanup_batch_size
+        )
+        if not memos:
+            return expired
+
+        pipe = redis.pipeline()
+        for memo in memos:
+            pipe.delete(f"transaction:{memo}", f"payment:{memo}")
+        pipe.zrem(TRANSACTION_EXPIRY_KEY, *memos)
+        await pipe.execute()
+
+        for memo in memos:
+            qr_cache.pop(memo)
+        if config.qr_storage == 'disk':
+            await asyncio.get_running_loop().run_in_executor(None, remove_qr_files, memos)
+
+        expired += len(memos)
+        if len(memos) < config.cleanup_batch_size:
+            return expired
+
+def remove_qr_files(memos: List[str]) -> None:
+    for memo in memos:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(f"qr_codes/{memo}.png")
+
 async def cleanup_old_transactions() -> None:
     while True:
         try:
-            current_time = datetime.utcnow()
-            async for key in redis.scan_iter("transaction:*"):
-                ttl = await redis.ttl(key)
-                if ttl < 0:
-                    await redis.delete(key)
-            await asyncio.sleep(3600)  # Run every hour
+            expired = await expire_due_transactions()
+            if expired:
+                logger.info(f"Cleaned up {expired} expired transactions")
+            await asyncio.sleep(config.cleanup_interval)
         except Exception as e:
             logger.error(f"Error in cleanup task: {str(e)}", exc_info=True)
             sentry_sdk.capture_exception(e)
             await asyncio.sleep(60)  # Wait a minute before retrying
 
+# A Redis lease held by at most one worker across all server processes
+class Lease:
+    def __init__(self, name: str, ttl: float):
+        self.key = f"lease:{name}"
+        self.ttl_ms = int(ttl * 1000)
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{b58encode(os.urandom(8)).decode('ascii')}"
+        self.renew_script = redis.register_script(RENEW_LEASE_SCRIPT)
+        self.release_script = redis.register_script(RELEASE_LEASE_SCRIPT)
+
+    async def acquire(self) -> bool:
+        return bool(await redis.set(self.key, self.token, nx=True, px=self.ttl_ms))
+
+    async def renew(self) -> bool:
+        return bool(await self.renew_script(keys=[self.key], args=[self.token, self.ttl_ms]))
+
+    async def release(self) -> None:
+        await self.release_script(keys=[self.key], args=[self.token])
+
+# Runs a background job in only one worker at a time. Every worker competes for the
+# lease; the holder runs the job and renews the lease, the others stand by.
+async def run_with_lease(name: str, job: Callable[[], Awaitable[None]]) -> None:
+    lease = Lease(name, config.lease_ttl)
+    renew_interval = config.lease_ttl / 3
+    while True:
+        try:
+            if not await lease.acquire():
+                await asyncio.sleep(renew_interval)
+                continue
+
+            logger.info(f"Acquired {name} lease in worker {os.getpid()}")
+            task = asyncio.create_task(job())
+            try:
+                while not task.done():
+                    await asyncio.sleep(renew_interval)
+                    if not await lease.renew():
+                        logger.warning(f"Lost {name} lease in worker {os.getpid()}")
+                        break
+            finally:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+                await lease.release()
+        except Exception as e:
+            logger.error(f"Error in {name} lease: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            await asyncio.sleep(renew_interval)
+
+async def init_resources(app: web.Application) -> None:
+    global fernet, qr_cache, solana_rpc, redis, crypto_executor, rate_limiter, inventory_sync_script
+    from cryptography.fernet import Fernet
+
+    if config.sentry_dsn:
+        from sentry_sdk.integrations.aiohttp import AioHttpIntegration
+        sentry_sdk.init(
+            dsn=config.sentry_dsn,
+            integrations=[AioHttpIntegration()],
+            traces_sampler=TraceSampler(config.traces_sample_rate, config.max_traces_per_second)
+        )
+    fernet = Fernet(config.encryption_key)
+    qr_cache = TTLCache(config.qr_cache_size, config.qr_cache_ttl)
+    solana_rpc = SolanaRpcClient(
+        config.solana_rpc_endpoints, max_batch_size=config.rpc_max_batch_size, observer=observe_rpc_call
+    )
+    redis = aioredis.from_url(config.redis_url, decode_responses=True)
+    crypto_executor = ThreadPoolExecutor(max_workers=config.crypto_workers, thread_name_prefix='crypto')
+    rate_limiter = RateLimiter({**DEFAULT_RATE_LIMITS, **config.rate_limits}, config.machines_per_api_key)
+    inventory_sync_script = redis.register_script(INVENTORY_SYNC_SCRIPT)
+
+async def close_resources(app: web.Application) -> None:
+    await solana_rpc.close()
+    await redis.close()
+    crypto_executor.shutdown(wait=False)
+
+# Touches every dependency once so the first real requests do not pay for the Redis
+# connection, thread pool start-up or first-use imports; /ready reports when it is done
+async def warm_up() -> None:
+    global ready
+    while True:
+        try:
+            await redis.ping()
+            await decrypt_record(await encrypt_record({}))
+            await render_qr(build_payment_url(config.merchant_wallet, 0, 'warmup', config.merchant_wallet))
+            break
+        except Exception as e:
+            logger.error(f"Error warming up: {str(e)}", exc_info=True)
+            sentry_sdk.capture_exception(e)
+            await asyncio.sleep(1)
+    ready = True
+    logger.info(f"Worker {os.getpid()} ready")
+
 async def start_background_tasks(app: web.Application) -> None:
-    app['cleanup_task'] = asyncio.create_task(cleanup_old_transactions())
+    # The worker starts accepting connections right away and warms up in the background
+    app['warm_up_task'] = asyncio.create_task(warm_up())
+    # Cleanup and the chain watcher are fleet-wide singletons; the notifier runs per worker
+    app['cleanup_task'] = asyncio.create_task(run_with_lease('cleanup', cleanup_old_transactions))
+    watcher = PaymentWatcher(
+        config.merchant_wallet, config.watcher_interval, config.watcher_page_size, config.watcher_missing_timeout
+    )
+    app['payment_watcher_task'] = asyncio.create_task(run_with_lease('payment_watcher', watcher.run))
+    app['payment_notifier_task'] = asyncio.create_task(payment_notifier.run())
 
 async def cleanup_background_tasks(app: web.Application) -> None:
-    app['cleanup_task'].cancel()
-    await app['cleanup_task']
+    for name in ('warm_up_task', 'cleanup_task', 'payment_watcher_task', 'payment_notifier_task'):
+        app[name].cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await app[name]
 
-app = web.Application(middlewares=[server_stats])
-app.router.add_post('/generate_payment', lambda r: validate_api_key(r, generate_payment))
-app.router.add_post('/verify_payment', lambda r: validate_api_key(r, verify_payment))
-app.router.add_get('/transaction_status', lambda r: validate_api_key(r, get_transaction_status))
-app.router.add_get('/metrics', server_stats)
-app.on_startup.append(start_background_tasks)
-app.on_cleanup.append(cleanup_background_tasks)
+def create_app(config_file: str = CONFIG_FILE) -> web.Application:
+    global config
+    config = Config(config_file)
+    app = web.Application()
+    app.router.add_post('/generate_payment', lambda r: validate_api_key(r, generate_payment))
+    app.router.add_post('/generate_payments', lambda r: validate_api_key(r, generate_payments))
+    app.router.add_post('/verify_payment', lambda r: validate_api_key(r, verify_payment))
+    app.router.add_post('/wait_payment', lambda r: validate_api_key(r, wait_payment))
+    app.router.add_get('/transaction_status', lambda r: validate_api_key(r, get_transaction_status))
+    app.router.add_post('/transaction_status_batch', lambda r: validate_api_key(r, get_transaction_statuses))
+    app.router.add_get('/qr/{memo}', lambda r: validate_api_key(r, get_qr_code))
+    app.router.add_post('/inventory_sync', lambda r: validate_api_key(r, sync_inventory))
+    app.router.add_get('/inventory', lambda r: validate_api_key(r, get_inventory))
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/ready', readiness)
+    app.on_startup.append(init_resources)
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(cleanup_background_tasks)
+    app.on_cleanup.append(close_resources)
+    return app
 
-if __name__ == '__main__':
+def run_worker() -> None:
+    app = create_app()
     ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     ssl_context.load_cert_chain(config.ssl_cert, config.ssl_key)
-    web.run_app(app, host=config.host, port=config.port, ssl_context=ssl_context)
\ No newline at end of file
+    # With several workers each one binds its own SO_REUSEPORT socket and the kernel
+    # spreads incoming connections across them.
+    web.run_app(app, host=config.host, port=config.port, ssl_context=ssl_context,
+                reuse_port=config.workers > 1)
+
+# A worker that exits sooner than this after starting counts as failing at startup
+WORKER_MIN_UPTIME = 10
+WORKER_MAX_STARTUP_FAILURES = 5
+WORKER_MAX_RESTART_DELAY = 60
+
+# Starts the configured number of workers and restarts any that die until we are
+# asked to stop. Workers that keep dying at startup (a bad certificate, a port in
+# use...) are restarted with exponential backoff, and after repeated failures the
+# supervisor gives up. Returns the process exit code.
+def supervise_workers(count: int) -> int:
+    def start_worker() -> multiprocessing.Process:
+        process = multiprocessing.Process(target=run_worker)
+        process.start()
+        return process
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    workers = [start_worker() for _ in range(count)]
+    started = [time.monotonic()] * count
+    failures = [0] * count
+    restart_at: List[Optional[float]] = [None] * count
+    exit_code = 0
+    logger.info(f"Started {count} workers: {[w.pid for w in workers]}")
+    while not stopping:
+        now = time.monotonic()
+        for i, worker in enumerate(workers):
+            if restart_at[i] is not None:
+                if now >= restart_at[i]:
+                    restart_at[i] = None
+                    workers[i] = start_worker()
+                    started[i] = now
+                continue
+            if worker.is_alive():
+                continue
+            if now - started[i] < WORKER_MIN_UPTIME:
+                failures[i] += 1
+            else:
+                failures[i] = 0
+            if failures[i] >= WORKER_MAX_STARTUP_FAILURES:
+                logger.error(f"Worker {worker.pid} exited with code {worker.exitcode}; "
+                             f"{failures[i]} startup failures in a row, giving up")
+                exit_code = 1
+                stopping = True
+                break
+            delay = min(WORKER_MAX_RESTART_DELAY, 2 ** (failures[i] - 1)) if failures[i] else 0
+            logger.warning(f"Worker {worker.pid} exited with code {worker.exitcode}, restarting in {delay}s")
+            restart_at[i] = now + delay
+        time.sleep(1)
+
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+    for worker in workers:
+        worker.join()
+    return exit_code
+
+if __name__ == '__main__':
+    workers = Config(CONFIG_FILE).workers
+    if workers > 1:
+        sys.exit(supervise_workers(workers))
+    else:
+        run_worker()
\ No newline at end of file
@@ -1,11 +1,16 @@
-import requests
+import os
 import time
 import logging
 import asyncio
 import json
-from pymdb import MDBInterface, MDBDevice
-from typing import Dict, Optional, List
-from dataclasses import dataclass, asdict
+import random
+import socket
+import sqlite3
+import threading
+import aiohttp
+from typing import Callable, Deque, Dict, Optional, List, Set, Tuple
+from collections import defaultdict, deque
+from dataclasses import dataclass, asdict, field
 from abc import ABC, abstractmethod
 from concurrent.futures import ThreadPoolExecutor
 
@@ -20,6 +25,26 @@ class Config:
     solana_wallet_address: str
     payment_verification_timeout: int
     payment_verification_interval: int
+    payment_long_poll_timeout: int = 25
+    machine_id: str = socket.gethostname()
+    http_pool_size: int = 10
+    http_keepalive_timeout: float = 60
+    http_connect_timeout: float = 5
+    http_request_timeout: float = 15
+    http_max_retries: int = 3
+    http_backoff_base: float = 0.5
+    http_backoff_max: float = 8
+    payment_pool_size: int = 2
+    payment_pool_refresh_interval: float = 60
+    payment_pool_expiry_margin: float = 300
+    vend_timeout: float = 30
+    mdb_poll_interval: float = 0.05
+    # Poll responses that end a vend; adjust to the names your MDB driver reports
+    mdb_vend_success_responses: List[str] = field(default_factory=lambda: ["VEND_SUCCESS", "VEND_COMPLETE"])
+    mdb_vend_failure_responses: List[str] = field(default_factory=lambda: ["VEND_FAILURE", "VEND_FAILED", "VEND_DENIED"])
+    inventory_db_path: str = "inventory.db"
+    inventory_sync_interval: float = 30
+    inventory_sync_batch_size: int = 500
 
     @classmethod
     def load_from_file(cls, filename: str) -> 'Config':
@@ -27,8 +52,6 @@ class Config:
             config_data = json.load(f)
         return cls(**config_data)
 
-config = Config.load_from_file(CONFIG_FILE)
-
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -49,82 +72,495 @@ class PaymentGateway(ABC):
     async def verify_payment(self, memo: str) -> bool:
         pass
 
+    async def wait_for_payment(self, memo: str, timeout: float) -> bool:
+        # Gateways without server push fall back to a single verification
+        return await self.verify_payment(memo)
+
+# Responses worth retrying; anything else is returned or raised immediately
+RETRY_STATUSES = {429, 502, 503, 504}
+
 class SolanaPaymentGateway(PaymentGateway):
     def __init__(self, config: Config):
         self.config = config
+        self.session: Optional[aiohttp.ClientSession] = None
+        # Pre-issued payment references per (slot, price), oldest first
+        self.payment_pool: Dict[Tuple[str, float], Deque[dict]] = {}
+        self.refill_tasks: Dict[Tuple[str, float], asyncio.Task] = {}
 
-    async def get_payment_url(self, item: Item) -> Optional[str]:
-        url = f"{self.config.server_url}/generate_payment"
-        headers = {"API-Key": self.config.api_key}
-        payload = {
+    async def __aenter__(self) -> 'SolanaPaymentGateway':
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.config.http_pool_size,
+                keepalive_timeout=self.config.http_keepalive_timeout
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.config.http_request_timeout,
+                connect=self.config.http_connect_timeout
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={"API-Key": self.config.api_key, "Machine-Id": self.config.machine_id}
+            )
+
+    async def close(self):
+        for task in self.refill_tasks.values():
+            task.cancel()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def backoff_delay(self, attempt: int) -> float:
+        # Exponential backoff with full jitter
+        delay = min(self.config.http_backoff_max, self.config.http_backoff_base * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    async def post(self, path: str, payload: dict, timeout: Optional[aiohttp.ClientTimeout] = None,
+                   retries: Optional[int] = None) -> dict:
+        await self.open()
+        url = f"{self.config.server_url}{path}"
+        retries = self.config.http_max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            delay = self.backoff_delay(attempt)
+            try:
+                async with self.session.post(url, json=payload, timeout=timeout) as response:
+                    if response.status not in RETRY_STATUSES or attempt == retries:
+                        response.raise_for_status()
+                        return await response.json()
+                    logger.warning(f"{path} returned {response.status}, retrying")
+                    # Throttled requests tell us exactly how long to wait
+                    if response.headers.get("Retry-After", "").isdigit():
+                        delay = float(response.headers["Retry-After"])
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"{path} failed ({e!r}), retrying")
+            await asyncio.sleep(delay)
+
+    def payment_payload(self, item: Item) -> dict:
+        return {
             "item_price": item.price,
             "recipient_wallet": self.config.solana_wallet_address,
             "item_slot": item.slot
         }
+
+    def take_pooled_payment(self, item: Item) -> Optional[dict]:
+        pool = self.payment_pool.get((item.slot, item.price))
+        # References close to expiry are dropped; the refill replaces them
+        cutoff = time.time() + self.config.payment_pool_expiry_margin
+        while pool:
+            payment = pool.popleft()
+            if payment['expires_at'] > cutoff:
+                return payment
+        return None
+
+    def schedule_refill(self, item: Item) -> Optional[asyncio.Task]:
+        # Returns the refill running for the item, if any
+        key = (item.slot, item.price)
+        task = self.refill_tasks.get(key)
+        if self.config.payment_pool_size <= 0 or (task is not None and not task.done()):
+            return task
+        task = self.refill_tasks[key] = asyncio.create_task(self.refill_pool(item))
+        return task
+
+    async def refill_pool(self, item: Item):
+        pool = self.payment_pool.setdefault((item.slot, item.price), deque())
+        cutoff = time.time() + self.config.payment_pool_expiry_margin
+        while pool and pool[0]['expires_at'] <= cutoff:
+            pool.popleft()
+        missing = self.config.payment_pool_size - len(pool)
+        if missing <= 0:
+            return
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-                    logger.info(f"Payment URL: {data['payment_url']}")
-                    logger.info(f"QR Code saved at: {data['qr_code_path']}")
-                    return data['memo']
-        except aiohttp.ClientError as e:
+            payload = {**self.payment_payload(item), "count": missing}
+            data = await self.post("/generate_payments", payload)
+            pool.extend(data['payments'])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Could not refill payment pool for slot {item.slot}: {e}")
+
+    async def maintain_payment_pool(self, list_items: Callable[[], List[Item]]):
+        # Keeps a few references ready for every in-stock item and recycles expired ones
+        while True:
+            for item in list_items():
+                if item.quantity > 0:
+                    # One slot at a time, so a full refill does not burst past the
+                    # server's generate_payments budget
+                    task = self.schedule_refill(item)
+                    if task is not None:
+                        await asyncio.wait([task])
+            await asyncio.sleep(self.config.payment_pool_refresh_interval)
+
+    async def get_payment_url(self, item: Item) -> Optional[str]:
+        data = self.take_pooled_payment(item)
+        try:
+            if data is None:
+                data = await self.post("/generate_payment", self.payment_payload(item))
+            logger.info(f"Payment URL: {data['payment_url']}")
+            logger.info(f"QR Code available at: {self.config.server_url}{data['qr_code_url']}")
+            return data['memo']
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Error generating payment URL: {e}")
             return None
+        finally:
+            self.schedule_refill(item)
+
+    async def sync_inventory(self, store_id: str, updates: List[Tuple[int, str, int]]):
+        await self.post("/inventory_sync", {
+            "machine_id": self.config.machine_id,
+            "store_id": store_id,
+            "updates": [list(update) for update in updates]
+        })
 
     async def verify_payment(self, memo: str) -> bool:
-        url = f"{self.config.server_url}/verify_payment"
-        headers = {"API-Key": self.config.api_key}
-        payload = {"memo": memo}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    response.raise_for_status()
-                    result = await response.json()
-                    if result['status'] == "verified":
-                        logger.info("Payment verified")
-                        return True
-                    else:
-                        logger.info("Payment not found or not confirmed")
-                        return False
-        except aiohttp.ClientError as e:
+            result = await self.post("/verify_payment", {"memo": memo})
+            if result['status'] == "verified":
+                logger.info("Payment verified")
+                return True
+            else:
+                logger.info("Payment not found or not confirmed")
+                return False
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Error verifying payment: {e}")
             return False
 
+    async def wait_for_payment(self, memo: str, timeout: float) -> bool:
+        # The server holds the request for up to `timeout` seconds; the caller loops,
+        # so a failed long poll is not retried here.
+        client_timeout = aiohttp.ClientTimeout(total=timeout + 10, connect=self.config.http_connect_timeout)
+        try:
+            result = await self.post("/wait_payment", {"memo": memo, "timeout": timeout},
+                                     timeout=client_timeout, retries=0)
+            if result['status'] == "verified":
+                logger.info("Payment verified")
+                return True
+            return False
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Error waiting for payment: {e}")
+            return False
+
+# Crash-safe local inventory in SQLite (WAL mode). Every quantity change is stored
+# together with the new stock level in an outbox that InventorySync drains to the server.
+class InventoryStore:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "slot TEXT PRIMARY KEY, price REAL NOT NULL, name TEXT NOT NULL, quantity INTEGER NOT NULL)"
+        )
+        # Outbox of stock levels to report, in id order
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS stock_updates ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, slot TEXT NOT NULL, quantity INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        # Identifies this database to the server, whose applied-id watermark is kept per
+        # store, so a replaced or wiped database starting again at id 1 is not ignored
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('store_id', ?)", (os.urandom(8).hex(),))
+        self.store_id: str = self.conn.execute("SELECT value FROM meta WHERE key = 'store_id'").fetchone()[0]
+
+    def seed(self, items: List[Item]):
+        # New slots are added and price or name changes applied; stored quantities
+        # survive restarts. Every slot's stock is queued so the server starts in sync.
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO items (slot, price, name, quantity) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(slot) DO UPDATE SET price = excluded.price, name = excluded.name",
+                [(item.slot, item.price, item.name, item.quantity) for item in items]
+            )
+            self.conn.execute(
+                "INSERT INTO stock_updates (slot, quantity, created_at) SELECT slot, quantity, ? FROM items",
+                (time.time(),)
+            )
+
+    def load_items(self) -> Dict[str, Item]:
+        with self.lock:
+            rows = self.conn.execute("SELECT slot, price, name, quantity FROM items").fetchall()
+        return {slot: Item(slot, price, name, quantity) for slot, price, name, quantity in rows}
+
+    def set_quantity(self, slot: str, quantity: int):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE items SET quantity = ? WHERE slot = ?", (quantity, slot))
+            self.conn.execute(
+                "INSERT INTO stock_updates (slot, quantity, created_at) VALUES (?, ?, ?)",
+                (slot, quantity, time.time())
+            )
+
+    def pending_updates(self, limit: int) -> List[Tuple[int, str, int]]:
+        # The oldest queued (id, slot, quantity) rows
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, slot, quantity FROM stock_updates ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+
+    def ack_updates(self, last_id: int):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM stock_updates WHERE id <= ?", (last_id,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
 class Inventory:
-    def __init__(self, items: Dict[str, Item]):
+    def __init__(self, items: Dict[str, Item], store: Optional[InventoryStore] = None):
         self.items = items
+        self.store = store
 
     def get_item(self, slot: str) -> Optional[Item]:
         return self.items.get(slot)
 
-    def update_quantity(self, slot: str, quantity: int):
+    async def update_quantity(self, slot: str, quantity: int):
         if slot in self.items:
             self.items[slot].quantity = quantity
+            if self.store is not None:
+                # The SQLite commit blocks, and waits on the lock the sync thread holds
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.store.set_quantity, slot, quantity)
 
     def list_items(self) -> List[Item]:
         return list(self.items.values())
 
+# Write-behind sync: pushes batched stock levels from the local outbox to the
+# server when it is reachable. Vends never wait on it; a failed push is retried on
+# the next pass and the outbox keeps growing until connectivity returns.
+class InventorySync:
+    def __init__(self, config: Config, store: InventoryStore, payment_gateway: 'SolanaPaymentGateway'):
+        self.config = config
+        self.store = store
+        self.payment_gateway = payment_gateway
+
+    async def run(self):
+        while True:
+            try:
+                while await self.push_batch():
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Inventory sync deferred: {e}")
+            except Exception as e:
+                logger.error(f"Error syncing inventory: {e}")
+            await asyncio.sleep(self.config.inventory_sync_interval)
+
+    async def push_batch(self) -> bool:
+        loop = asyncio.get_running_loop()
+        updates = await loop.run_in_executor(None, self.store.pending_updates, self.config.inventory_sync_batch_size)
+        if not updates:
+            return False
+        # Every row carries its outbox id and the server skips ids it has already
+        # applied, so a retried batch, even one that has since grown, applies each row once
+        await self.payment_gateway.sync_inventory(self.store.store_id, updates)
+        last_id = updates[-1][0]
+        await loop.run_in_executor(None, self.store.ack_updates, last_id)
+        logger.info(f"Synced stock updates up to #{last_id}")
+        return True
+
+SIMULATED_MDB_PORT = "simulated"
+
+# Polls spent discarding outcomes left over from a timed-out vend before the next one
+STALE_OUTCOME_DRAIN_LIMIT = 5
+# Longest wait between polls while the bus keeps failing
+MAX_POLL_BACKOFF = 1.0
+
+# Async wrapper around the synchronous MDB driver. All bus I/O (vend requests and
+# polls) runs on one dedicated thread. The bus is only polled while a vend is
+# pending, and the vend completes when a poll response (compared case-insensitively
+# by str()) is one of success_responses or failure_responses.
+class AsyncMDBDevice:
+    def __init__(self, device, poll_interval: float, success_responses: List[str], failure_responses: List[str]):
+        self.device = device
+        self.poll_interval = poll_interval
+        self.success_responses = {response.upper() for response in success_responses}
+        self.failure_responses = {response.upper() for response in failure_responses}
+        self.unrecognized: Set[str] = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mdb-bus")
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def on_bus(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def outcome(self, response) -> Optional[bool]:
+        if response is None:
+            return None
+        name = str(response).upper()
+        if name in self.success_responses:
+            return True
+        if name in self.failure_responses:
+            return False
+        if name not in self.unrecognized:
+            # Warn once per response, so a driver that names outcomes differently is easy to spot
+            self.unrecognized.add(name)
+            logger.warning(f"Ignoring unrecognized MDB poll response {name!r}; see mdb_vend_success_responses")
+        return None
+
+    def request_vend(self, slot: str):
+        # Runs on the bus thread. Outcomes still queued from an earlier, timed-out vend
+        # are drained first so they cannot complete this one.
+        try:
+            for _ in range(STALE_OUTCOME_DRAIN_LIMIT):
+                if self.outcome(self.device.poll()) is None:
+                    break
+        except Exception as e:
+            logger.warning(f"Error draining MDB poll responses before vend: {e}")
+        self.device.vend_request(slot)
+
+    def poll_device(self) -> Optional[bool]:
+        return self.outcome(self.device.poll())
+
+    async def wait_for_outcome(self) -> bool:
+        delay = self.poll_interval
+        failing = False
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                outcome = await self.on_bus(self.poll_device)
+            except Exception as e:
+                # A transient bus error must not fail a vend that may be dispensing; the
+                # vend's own timeout bounds how long we keep polling
+                if not failing:
+                    logger.error(f"Error polling MDB device: {e}")
+                failing = True
+                delay = min(delay * 2, MAX_POLL_BACKOFF)
+                continue
+            if failing:
+                logger.info("MDB device polls recovered")
+                failing = False
+                delay = self.poll_interval
+            if outcome is not None:
+                return outcome
+
+    async def vend(self, slot: str, timeout: float) -> bool:
+        # Callers serialize vends, so at most one is pending at a time
+        async def request_and_wait() -> bool:
+            await self.on_bus(self.request_vend, slot)
+            return await self.wait_for_outcome()
+        return await asyncio.wait_for(request_and_wait(), timeout)
+
+# Stand-in for MDBDevice when no hardware is attached (mdb_port "simulated"). Reports
+# success after dispense_time seconds, or failure for slots listed in fail_slots.
+class SimulatedMDBDevice:
+    def __init__(self, dispense_time: float = 0.5, fail_slots: Optional[Set[str]] = None):
+        self.dispense_time = dispense_time
+        self.fail_slots = fail_slots or set()
+        self.vends: List[str] = []
+        self.current: Optional[Tuple[str, float]] = None
+
+    def vend_request(self, slot: str):
+        self.vends.append(slot)
+        self.current = (slot, time.monotonic())
+
+    def poll(self):
+        if self.current is None:
+            return None
+        slot, started = self.current
+        if time.monotonic() - started < self.dispense_time:
+            return None
+        self.current = None
+        return "VEND_FAILURE" if slot in self.fail_slots else "VEND_SUCCESS"
+
+@dataclass
+class Selection:
+    point: str
+    slot: str
+
+# Where customer selections come from: a console, a keypad per door, a touch screen...
+class SelectionSource(ABC):
+    # Waits for the next selection; returns None once the source is closed
+    @abstractmethod
+    async def next_selection(self) -> Optional[Selection]:
+        pass
+
+class ConsoleSelectionSource(SelectionSource):
+    def __init__(self, point: str = "console"):
+        self.point = point
+
+    async def next_selection(self) -> Optional[Selection]:
+        # input() blocks, so it runs in a thread and the event loop keeps serving other sessions
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, input, "Select an item slot (e.g., A1) or 'q' to quit: ")
+            selected_slot = line.strip().upper()
+            if selected_slot == 'Q':
+                return None
+            if selected_slot:
+                return Selection(self.point, selected_slot)
+
+# Selection source fed by other code, e.g. a keypad driver callback or a test
+class QueueSelectionSource(SelectionSource):
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def select(self, point: str, slot: str):
+        self.queue.put_nowait(Selection(point, slot))
+
+    def close(self):
+        self.queue.put_nowait(None)
+
+    async def next_selection(self) -> Optional[Selection]:
+        return await self.queue.get()
+
 class VendingMachine:
     def __init__(self, config: Config, inventory: Inventory, payment_gateway: PaymentGateway):
         self.config = config
         self.inventory = inventory
         self.payment_gateway = payment_gateway
-        self.mdb_interface = MDBInterface(config.mdb_port)
-        self.mdb_device = MDBDevice(self.mdb_interface)
+        if config.mdb_port == SIMULATED_MDB_PORT:
+            self.mdb_interface = None
+            self.mdb_device = SimulatedMDBDevice()
+        else:
+            from pymdb import MDBInterface, MDBDevice  # Only needed with real hardware
+            self.mdb_interface = MDBInterface(config.mdb_port)
+            self.mdb_device = MDBDevice(self.mdb_interface)
+        self.mdb = AsyncMDBDevice(self.mdb_device, config.mdb_poll_interval,
+                                  config.mdb_vend_success_responses, config.mdb_vend_failure_responses)
+        # Session state: one session per selection point, stock reserved per slot
+        self.slot_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.reserved: Dict[str, int] = defaultdict(int)
+        self.active_points: Set[str] = set()
+        self.sessions: Set[asyncio.Task] = set()
+        # The MDB bus handles one vend at a time, so all vends go through one queue
+        self.vend_queue: asyncio.Queue = asyncio.Queue()
 
     async def dispense_item(self, slot: str) -> bool:
         try:
-            self.mdb_device.vend_request(slot)
             logger.info(f"Dispensing item from slot {slot}...")
-            await asyncio.sleep(3)  # Simulate item dispensing delay
-            logger.info("Item dispensed.")
-            return True
+            if await self.mdb.vend(slot, self.config.vend_timeout):
+                logger.info("Item dispensed.")
+                return True
+            logger.warning(f"Vend failed for slot {slot}.")
+            return False
+        except asyncio.TimeoutError:
+            logger.error(f"Vend for slot {slot} timed out after {self.config.vend_timeout}s")
+            return False
         except Exception as e:
             logger.error(f"Error dispensing item: {e}")
             return False
 
+    async def vend_worker(self):
+        while True:
+            slot, result = await self.vend_queue.get()
+            try:
+                dispensed = await self.dispense_item(slot)
+                if not result.done():
+                    result.set_result(dispensed)
+            finally:
+                self.vend_queue.task_done()
+
+    async def request_vend(self, slot: str) -> bool:
+        result = asyncio.get_running_loop().create_future()
+        await self.vend_queue.put((slot, result))
+        return await result
+
     async def process_transaction(self, item: Item) -> bool:
         memo = await self.payment_gateway.get_payment_url(item)
         if not memo:
@@ -132,44 +568,80 @@ class VendingMachine:
 
         logger.info("Scan the QR code with your Solana wallet to make the payment.")
         
-        start_time = time.time()
-        while time.time() - start_time < self.config.payment_verification_timeout:
-            if await self.payment_gateway.verify_payment(memo):
-                if await self.dispense_item(item.slot):
-                    self.inventory.update_quantity(item.slot, item.quantity - 1)
+        deadline = time.time() + self.config.payment_verification_timeout
+        while (remaining := deadline - time.time()) > 0:
+            started = time.time()
+            if await self.payment_gateway.wait_for_payment(memo, min(remaining, self.config.payment_long_poll_timeout)):
+                if await self.request_vend(item.slot):
+                    async with self.slot_locks[item.slot]:
+                        await self.inventory.update_quantity(item.slot, item.quantity - 1)
                     return True
                 return False
-            await asyncio.sleep(self.config.payment_verification_interval)
+            # Only pace ourselves if the server answered early (error or fallback gateway)
+            elapsed = time.time() - started
+            if elapsed < self.config.payment_verification_interval:
+                await asyncio.sleep(self.config.payment_verification_interval - elapsed)
         
         logger.warning("Payment verification timed out.")
         return False
 
-    async def run(self):
-        while True:
-            self.display_items()
-            selected_slot = input("Select an item slot (e.g., A1) or 'q' to quit: ").strip().upper()
-            
-            if selected_slot == 'Q':
-                logger.info("Exiting the vending machine program.")
-                break
-            
-            item = self.inventory.get_item(selected_slot)
-            if not item:
-                logger.warning("Invalid slot selected. Try again.")
-                continue
+    async def start_session(self, selection: Selection):
+        if selection.point in self.active_points:
+            logger.warning(f"A transaction is already in progress at {selection.point}.")
+            return
+
+        item = self.inventory.get_item(selection.slot)
+        if not item:
+            logger.warning("Invalid slot selected. Try again.")
+            return
 
-            if item.quantity <= 0:
+        # Reserve one unit so concurrent sessions cannot sell the same last item
+        async with self.slot_locks[item.slot]:
+            if item.quantity - self.reserved[item.slot] <= 0:
                 logger.warning(f"Item {item.name} is out of stock.")
-                continue
+                return
+            self.reserved[item.slot] += 1
 
-            logger.info(f"Selected item: {item.name}, Price: {item.price} SOL")
-            
+        logger.info(f"[{selection.point}] Selected item: {item.name}, Price: {item.price} SOL")
+        self.active_points.add(selection.point)
+        task = asyncio.create_task(self.run_session(selection.point, item))
+        self.sessions.add(task)
+        task.add_done_callback(self.sessions.discard)
+
+    async def run_session(self, point: str, item: Item):
+        try:
             if await self.process_transaction(item):
-                logger.info("Transaction completed successfully.")
+                logger.info(f"[{point}] Transaction completed successfully.")
             else:
-                logger.warning("Transaction failed. Please try again.")
-            
-            await asyncio.sleep(5)
+                logger.warning(f"[{point}] Transaction failed. Please try again.")
+        except Exception as e:
+            logger.error(f"[{point}] Error in transaction: {e}")
+        finally:
+            async with self.slot_locks[item.slot]:
+                self.reserved[item.slot] -= 1
+            self.active_points.discard(point)
+
+    async def serve(self, source: SelectionSource):
+        while True:
+            self.display_items()
+            selection = await source.next_selection()
+            if selection is None:
+                return
+            await self.start_session(selection)
+
+    async def run(self, sources: Optional[List[SelectionSource]] = None):
+        sources = sources or [ConsoleSelectionSource()]
+        vend_worker = asyncio.create_task(self.vend_worker())
+        try:
+            await asyncio.gather(*(self.serve(source) for source in sources))
+            # Let customers who already paid or are paying finish before shutting down
+            if self.sessions:
+                await asyncio.gather(*self.sessions, return_exceptions=True)
+            logger.info("Exiting the vending machine program.")
+        finally:
+            vend_worker.cancel()
+            await asyncio.gather(vend_worker, return_exceptions=True)
+            await self.mdb.close()
 
     def display_items(self):
         logger.info("\nAvailable items:")
@@ -179,17 +651,29 @@ class VendingMachine:
 
 async def main():
     config = Config.load_from_file(CONFIG_FILE)
-    inventory = Inventory({
-        "A1": Item("A1", 0.5, "Cola", 10),
-        "A2": Item("A2", 0.75, "Water", 15),
-        "A3": Item("A3", 1.0, "Energy Drink", 8),
-        "B1": Item("B1", 1.25, "Chips", 12),
-        "B2": Item("B2", 1.5, "Chocolate Bar", 20),
-        "B3": Item("B3", 2.0, "Sandwich", 5)
-    })
-    payment_gateway = SolanaPaymentGateway(config)
-    vending_machine = VendingMachine(config, inventory, payment_gateway)
-    await vending_machine.run()
+    store = InventoryStore(config.inventory_db_path)
+    store.seed([
+        Item("A1", 0.5, "Cola", 10),
+        Item("A2", 0.75, "Water", 15),
+        Item("A3", 1.0, "Energy Drink", 8),
+        Item("B1", 1.25, "Chips", 12),
+        Item("B2", 1.5, "Chocolate Bar", 20),
+        Item("B3", 2.0, "Sandwich", 5)
+    ])
+    inventory = Inventory(store.load_items(), store)
+    async with SolanaPaymentGateway(config) as payment_gateway:
+        background_tasks = [
+            asyncio.create_task(InventorySync(config, store, payment_gateway).run()),
+            asyncio.create_task(payment_gateway.maintain_payment_pool(inventory.list_items))
+        ]
+        try:
+            vending_machine = VendingMachine(config, inventory, payment_gateway)
+            await vending_machine.run()
+        finally:
+            for task in background_tasks:
+                task.cancel()
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+            store.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file